@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    benchmark.py                                                             #
+#                                                                             #
+#    Time create, diff and update on synthetic trees served over loopback     #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__REPORT_VERSION__ = 2       # bump when the layout of the JSON report changes
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import sys
+import re
+import math
+import time
+import random
+import shutil
+import tempfile
+import threading
+import platform
+import urllib
+import cPickle
+import traceback
+import BaseHTTPServer
+import SocketServer
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+# local includes
+from screamingbackpack.manifestManager import ManifestManager, __MANIFEST__
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def makeTree(root,
+             files=1000,
+             size=65536,
+             distribution='lognormal',
+             depth=3,
+             fanout=8,
+             seed=0):
+    """Fill root with a synthetic tree of random (incompressible) files
+
+    size is the mean file size. distribution is one of:
+        fixed     - every file is exactly size bytes
+        uniform   - between 0 and 2 * size bytes
+        lognormal - mostly small files with a long tail of big ones
+    Files are spread over folders up to depth levels deep with at most
+    fanout sub folders each. The layout and sizes only depend on seed.
+    returns (number of files, total bytes)
+    """
+    rng = random.Random(seed)
+    total = 0
+    for i in range(files):
+        parts = ["d%d" % rng.randrange(fanout) for level in range(rng.randint(0, depth))]
+        folder = os.path.join(root, *parts)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        file_size = randomSize(rng, size, distribution)
+        writeRandomFile(os.path.join(folder, "f%d" % i), file_size)
+        total += file_size
+    return (files, total)
+
+def randomSize(rng, size, distribution):
+    if distribution == 'fixed':
+        return size
+    if distribution == 'uniform':
+        return rng.randint(0, 2 * size)
+    if distribution == 'lognormal':
+        # sigma of 1.5 puts ~10% of the bytes in the largest 1% of files
+        sigma = 1.5
+        mu = math.log(max(1, size)) - sigma * sigma / 2
+        return int(rng.lognormvariate(mu, sigma))
+    raise ValueError("unknown size distribution %s" % distribution)
+
+def writeRandomFile(fileName, size, blocksize=1024 * 1024):
+    with open(fileName, 'wb') as fh:
+        while size > 0:
+            chunk = min(size, blocksize)
+            fh.write(os.urandom(chunk))
+            size -= chunk
+
+def mutateTree(root, modify=0.05, add=0.05, delete=0.05, size=65536, distribution='lognormal', seed=0):
+    """Change a fraction of the files in a tree as a source update would
+
+    Modified files have up to 4 KiB rewritten in place.
+    returns the number of files (modified, added, deleted)
+    """
+    rng = random.Random(seed + 1)
+    paths = []
+    for (dir_path, dir_names, file_names) in os.walk(root):
+        dir_names.sort()
+        for name in sorted(file_names):
+            if not name.startswith(__MANIFEST__):
+                paths.append(os.path.join(dir_path, name))
+    rng.shuffle(paths)
+    n_modify = int(len(paths) * modify)
+    n_delete = int(len(paths) * delete)
+    n_add = int(len(paths) * add)
+    for path in paths[:n_modify]:
+        file_size = os.path.getsize(path)
+        with open(path, 'r+b') as fh:
+            fh.seek(rng.randint(0, max(0, file_size - 4096)))
+            fh.write(os.urandom(min(4096, file_size) or 1))
+    for path in paths[n_modify:n_modify + n_delete]:
+        os.remove(path)
+    for i in range(n_add):
+        writeRandomFile(os.path.join(root, "new%d" % i), randomSize(rng, size, distribution))
+    return (n_modify, n_add, n_delete)
+
+def treeSize(root):
+    """returns (number of files, total bytes) excluding manifests"""
+    files = 0
+    total = 0
+    for (dir_path, dir_names, file_names) in os.walk(root):
+        for name in file_names:
+            if not name.startswith(__MANIFEST__):
+                files += 1
+                total += os.path.getsize(os.path.join(dir_path, name))
+    return (files, total)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class SourceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve files (and byte ranges of files) from the server's root"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+        path = os.path.join(server.root, urllib.unquote(self.path.split("?")[0].lstrip("/")))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        (start, end) = (0, size - 1)
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get('Range', ""))
+        if match is not None:
+            if match.group(1) != "":
+                start = int(match.group(1))
+            if match.group(2) != "":
+                end = min(end, int(match.group(2)))
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        remaining = end - start + 1
+        with open(path, 'rb') as fh:
+            fh.seek(start)
+            while remaining > 0:
+                buf = fh.read(min(remaining, 65536))
+                if len(buf) == 0:
+                    break
+                self.wfile.write(buf)
+                remaining -= len(buf)
+        with server.lock:
+            server.bytesSent += end - start + 1 - remaining
+
+class SourceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Keep-alive HTTP server on the loopback interface
+
+    Every request is delayed by latency seconds to stand in for a real
+    network. Listens on a free port unless one is given
+    """
+    daemon_threads = True
+
+    def __init__(self, root, latency=0.0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), SourceRequestHandler)
+        self.root = root
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytesSent = 0
+        self.thread = None
+
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class BenchManager(ManifestManager):
+    """A ManifestManager which accepts every change without asking"""
+    def promptUserDownload(self):
+        return True
+
+    def promptUserDelete(self):
+        return True
+
+class Benchmark(object):
+    """Time the main operations on a synthetic tree
+
+    The tree is generated under workDir (a temporary folder by default) and
+    served by a SourceServer. Each phase is measured separately, see
+    measure() for what is recorded
+    """
+    def __init__(self,
+                 files=1000,
+                 size=65536,
+                 distribution='lognormal',
+                 depth=3,
+                 fanout=8,
+                 seed=0,
+                 latency=0.0,
+                 jobs=1,
+                 connections=4,
+                 hashAlgorithm='sha256',
+                 change=0.05,
+                 workDir=None,
+                 keep=False):
+        self.params = {'files': files,
+                       'size': size,
+                       'distribution': distribution,
+                       'depth': depth,
+                       'fanout': fanout,
+                       'seed': seed,
+                       'latency': latency,
+                       'jobs': jobs,
+                       'connections': connections,
+                       'hash': hashAlgorithm,
+                       'change': change}
+        self.workDir = workDir
+        self.keep = keep
+        self.phases = {}
+
+    def run(self):
+        """Generate the tree, run every phase and return the report"""
+        p = self.params
+        if self.workDir is None:
+            work_dir = tempfile.mkdtemp(prefix="sbbench")
+        else:
+            work_dir = self.workDir
+            if not os.path.isdir(work_dir):
+                os.makedirs(work_dir)
+        source = os.path.join(work_dir, "source")
+        local = os.path.join(work_dir, "local")
+        local_pipe = os.path.join(work_dir, "local_pipeline")
+        server = None
+        try:
+            makeTree(source, p['files'], p['size'], p['distribution'], p['depth'], p['fanout'], p['seed'])
+            (files, total) = treeSize(source)
+
+            MM = ManifestManager(manType="bench", jobs=p['jobs'])
+            # incremental so that a stat cache is written for the next phase
+            self.measure('create', files, total,
+                         MM.createManifest, source, incremental=True, sortEntries=True, hashAlgorithm=p['hash'])
+
+            # the local copy starts out in step with the source
+            shutil.copytree(source, local)
+            (modified, added, deleted) = mutateTree(source, p['change'], p['change'], p['change'], p['size'], p['distribution'], p['seed'])
+            (files, total) = treeSize(source)
+            MM = ManifestManager(manType="bench", jobs=p['jobs'])
+            self.measure('create_incremental', files, None,
+                         MM.createManifest, source, incremental=True, sortEntries=True, hashAlgorithm=p['hash'])
+
+            server = SourceServer(source, latency=p['latency'])
+            server.start()
+
+            MM = ManifestManager()
+            result = self.measure('diff', files, None,
+                                  MM.diffManifests, local, server.url())
+            changed = result[1] + result[4]
+            changed_bytes = sum([int(f[1][1]) for f in changed])
+
+            # both updates start from the same local tree
+            shutil.copytree(local, local_pipe)
+            MM = BenchManager(connections=p['connections'])
+            self.measureUpdate('update', server, len(changed), changed_bytes,
+                               MM.updateManifest, local, server.url(), reuse=None, pipeline=False)
+
+            MM = ManifestManager(connections=p['connections'])
+            self.measureUpdate('update_pipeline', server, len(changed), changed_bytes,
+                               MM.updateManifest, local_pipe, server.url(), reuse='reflink',
+                               approveDownload=True, approveDelete=True, pipeline=True)
+            for name in ['update', 'update_pipeline']:
+                self.phases[name]['modified'] = modified
+                self.phases[name]['added'] = added
+                self.phases[name]['deleted'] = deleted
+        finally:
+            if server is not None:
+                server.stop()
+            if not self.keep:
+                if self.workDir is None:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                else:
+                    shutil.rmtree(source, ignore_errors=True)
+                    shutil.rmtree(local, ignore_errors=True)
+                    shutil.rmtree(local_pipe, ignore_errors=True)
+        return self.report()
+
+    def measureUpdate(self, name, server, files, total, func, *args, **kwargs):
+        """measure an update, adding the requests and bytes the server saw"""
+        with server.lock:
+            (requests, sent) = (server.requests, server.bytesSent)
+        result = self.measure(name, files, total, func, *args, **kwargs)
+        with server.lock:
+            self.phases[name]['http_requests'] = server.requests - requests
+            self.phases[name]['http_bytes'] = server.bytesSent - sent
+        return result
+
+    def measure(self, name, files, total, func, *args, **kwargs):
+        """Run func, recording wall and cpu time, files/s, bytes/s, read and
+        write syscalls and the peak RSS (kB) of the phase
+
+        Where there is fork, func runs in a child process of its own so the
+        peak RSS isn't hidden by earlier phases; its result has to pickle.
+        Anything func prints is discarded. returns whatever func returns
+        """
+        if not hasattr(os, 'fork'):
+            (result, self.phases[name]) = self.runPhase(files, total, func, args, kwargs)
+            return result
+        sys.stdout.flush()
+        (read_fd, write_fd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                data = cPickle.dumps((True, self.runPhase(files, total, func, args, kwargs)), 2)
+            except BaseException:
+                data = cPickle.dumps((False, traceback.format_exc()), 2)
+            with os.fdopen(write_fd, 'wb') as out_fh:
+                out_fh.write(data)
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as in_fh:
+            data = in_fh.read()
+        os.waitpid(pid, 0)
+        if len(data) == 0:
+            raise RuntimeError("benchmark phase %s died" % name)
+        (ok, value) = cPickle.loads(data)
+        if not ok:
+            raise RuntimeError("benchmark phase %s failed:\n%s" % (name, value))
+        (result, self.phases[name]) = value
+        return result
+
+    def runPhase(self, files, total, func, args, kwargs):
+        """Call func and measure it (see measure)
+
+        returns (whatever func returns, the measurements)
+        """
+        before = self.usage()
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall = time.time() - start
+            sys.stdout.close()
+            sys.stdout = stdout
+        after = self.usage()
+        phase = {'wall_s': round(wall, 4), 'files': files}
+        phase['files_per_s'] = round(files / wall, 1) if wall > 0 else None
+        if total is not None:
+            phase['bytes'] = total
+            phase['bytes_per_s'] = round(total / wall, 1) if wall > 0 else None
+        for key in ['cpu_user_s', 'cpu_sys_s']:
+            if after[key] is not None:
+                phase[key] = round(after[key] - before[key], 4)
+            else:
+                phase[key] = None
+        for key in ['read_syscalls', 'write_syscalls']:
+            if after[key] is not None:
+                phase[key] = after[key] - before[key]
+            else:
+                phase[key] = None
+        phase['peak_rss_kb'] = after['peak_rss_kb']
+        return (result, phase)
+
+    def usage(self):
+        """Resource usage of this process and its finished children"""
+        usage = dict.fromkeys(['cpu_user_s', 'cpu_sys_s', 'peak_rss_kb', 'read_syscalls', 'write_syscalls'])
+        if resource is not None:
+            me = resource.getrusage(resource.RUSAGE_SELF)
+            kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+            usage['cpu_user_s'] = me.ru_utime + kids.ru_utime
+            usage['cpu_sys_s'] = me.ru_stime + kids.ru_stime
+            usage['peak_rss_kb'] = max(me.ru_maxrss, kids.ru_maxrss)
+            if sys.platform == 'darwin':
+                # reported in bytes rather than kB
+                usage['peak_rss_kb'] //= 1024
+        try:
+            # linux only, and only counts this process (not hashing workers)
+            with open("/proc/self/io") as io_fh:
+                for line in io_fh:
+                    (key, value) = line.split(":")
+                    if key == 'syscr':
+                        usage['read_syscalls'] = int(value)
+                    elif key == 'syscw':
+                        usage['write_syscalls'] = int(value)
+        except IOError:
+            pass
+        return usage
+
+    def report(self):
+        return {'report_version': __REPORT_VERSION__,
+                'screamingbackpack_version': __version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'params': self.params,
+                'phases': self.phases}
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
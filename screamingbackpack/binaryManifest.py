@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    binaryManifest.py                                                        #
+#                                                                             #
+#    Indexed binary companion to the text manifest (mmap + binary search)     #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__BINARY__ = ".idx"          # suffix of the binary companion to a manifest
+__MAGIC__ = "SBPM"
+__FORMAT_VERSION__ = 2
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import mmap
+import os
+import struct
+import binascii
+
+# local includes
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# magic, format version, digest size, type length, record count,
+# offset of the records, offset of the string table and the size,
+# mtime (ns) and inode of the text manifest it was made from
+HEADER = struct.Struct("<4sHHHQQQQqQ")
+
+class BinaryManifestError(Exception):
+    """Raised when a file is not a usable binary manifest"""
+    pass
+
+def writeBinaryManifest(fileName, manType, entries, digestSize=32, manifestKey=(0, 0, 0)):
+    """Write (path, digest, size) entries as a binary manifest
+
+    digest is the raw (not hex) digest, or "-" for a folder. manifestKey
+    is the (size, mtime_ns, inode) of the text manifest, so an index left
+    behind by an older manifest can be recognised. Layout:
+
+        header | type | records | string table
+
+    Records are fixed width and sorted by path so they can be binary
+    searched. Each one holds the offset and length of its path in the
+    string table, its size, a folder flag and its digest. The file is
+    written under a temporary name and renamed into place.
+    """
+    record = recordStruct(digestSize)
+    entries = sorted(entries)
+    records_offset = HEADER.size + len(manType)
+    strings_offset = records_offset + record.size * len(entries)
+    tmp_name = fileName + ".tmp"
+    with open(tmp_name, 'wb') as bin_fh:
+        bin_fh.write(HEADER.pack(__MAGIC__,
+                                 __FORMAT_VERSION__,
+                                 digestSize,
+                                 len(manType),
+                                 len(entries),
+                                 records_offset,
+                                 strings_offset,
+                                 manifestKey[0],
+                                 manifestKey[1],
+                                 manifestKey[2]))
+        bin_fh.write(manType)
+        string_pos = 0
+        for (path, digest, size) in entries:
+            if digest == "-":
+                bin_fh.write(record.pack(string_pos, len(path), size, 1, "\0" * digestSize))
+            else:
+                bin_fh.write(record.pack(string_pos, len(path), size, 0, digest))
+            string_pos += len(path)
+        for (path, digest, size) in entries:
+            bin_fh.write(path)
+    os.rename(tmp_name, fileName)
+
+def recordStruct(digestSize):
+    """path offset, path length, size, is folder, digest"""
+    return struct.Struct("<QIQB%ds" % digestSize)
+
+class BinaryManifest(object):
+    """Read only view of a binary manifest
+
+    The file is mmapped so point lookups and prefix scans only touch the
+    pages they need rather than parsing the whole manifest. If manifestKey
+    is given it must match the key the index was written with
+    """
+    def __init__(self, fileName, manifestKey=None):
+        self.fileName = fileName
+        with open(fileName, 'rb') as bin_fh:
+            try:
+                self.map = mmap.mmap(bin_fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                raise BinaryManifestError("%s is empty" % fileName)
+        if len(self.map) < HEADER.size:
+            raise BinaryManifestError("%s is too short to be a binary manifest" % fileName)
+        (magic,
+         version,
+         self.digestSize,
+         type_len,
+         self.count,
+         self.recordsOffset,
+         self.stringsOffset,
+         man_size,
+         man_mtime,
+         man_inode) = HEADER.unpack_from(self.map, 0)
+        if magic != __MAGIC__:
+            raise BinaryManifestError("%s is not a binary manifest" % fileName)
+        if version != __FORMAT_VERSION__:
+            raise BinaryManifestError("%s has unsupported format version %d" % (fileName, version))
+        if manifestKey is not None and tuple(manifestKey) != (man_size, man_mtime, man_inode):
+            self.map.close()
+            raise BinaryManifestError("%s was made from an older copy of the manifest" % fileName)
+        self.type = self.map[HEADER.size:HEADER.size + type_len]
+        self.record = recordStruct(self.digestSize)
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def pathAt(self, index):
+        (str_pos, str_len) = struct.unpack_from("<QI", self.map, self.recordsOffset + index * self.record.size)
+        start = self.stringsOffset + str_pos
+        return self.map[start:start + str_len]
+
+    def entryAt(self, index):
+        """returns (path, hash, size) just as they appear in the text manifest"""
+        (str_pos, str_len, size, is_dir, digest) = self.record.unpack_from(self.map, self.recordsOffset + index * self.record.size)
+        start = self.stringsOffset + str_pos
+        if is_dir:
+            hashd = "-"
+        else:
+            hashd = binascii.hexlify(digest)
+        return (self.map[start:start + str_len], hashd, size)
+
+    def lowerBound(self, path):
+        """index of the first record whose path is not less than path"""
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.pathAt(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, path):
+        """returns the (path, hash, size) for path or None"""
+        index = self.lowerBound(path)
+        if index < self.count and self.pathAt(index) == path:
+            return self.entryAt(index)
+        return None
+
+    def prefixScan(self, folder):
+        """Yield (path, hash, size) for everything below folder"""
+        prefix = folder.rstrip("/") + "/"
+        index = self.lowerBound(prefix)
+        while index < self.count and self.pathAt(index).startswith(prefix):
+            yield self.entryAt(index)
+            index += 1
+
+    def __iter__(self):
+        for index in xrange(self.count):
+            yield self.entryAt(index)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
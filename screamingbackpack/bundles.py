@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    bundles.py                                                               #
+#                                                                             #
+#    Pack small files into tar bundles so clients can fetch many at once      #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__BUNDLES__ = ".bundles"     # suffix of the sidecar listing where each small file is bundled
+__PACKS__ = ".packs"         # suffix of the folder holding the bundles themselves
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import tarfile
+from cStringIO import StringIO
+
+# local includes
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class BundleRun(object):
+    """A single byte range of one bundle holding files we need
+
+    members are (relative_path, local_path, hash, data offset, size) in
+    offset order. start and end are inclusive, as in a Range header
+    """
+    def __init__(self, bundle, members):
+        self.bundle = bundle
+        self.members = members
+        self.start = members[0][3]
+        self.end = members[-1][3] + members[-1][4] - 1
+
+    def jobs(self):
+        """The members as ordinary download jobs"""
+        return [m[:3] for m in self.members]
+
+def writeBundles(root, packsName, indexName, files, bundleSize, maxFileSize, changed=None):
+    """Pack every file no bigger than maxFileSize into tar bundles
+
+    files are (relative path, size) pairs. They are bundled in folder order
+    so that files from the same folder end up next to each other, with a
+    new bundle started once one reaches bundleSize. Bundles are plain tar
+    files. The index lists the bundle, data offset and size of each member
+    so clients can take members straight out of a byte range.
+
+    changed is the set of relative paths touched since the bundles were
+    last written. Bundles holding nothing from a folder in which something
+    was touched are kept as they are and only the rest are packed again.
+    If changed is None every bundle is packed again. New bundles never
+    reuse the name of an old one and the index is renamed into place, so
+    the index being served always describes bundles that exist. Old
+    bundles are removed once nothing refers to them.
+    """
+    packs_path = os.path.join(root, packsName)
+    index_path = os.path.join(root, indexName)
+    if not os.path.isdir(packs_path):
+        os.makedirs(packs_path)
+    small = dict([f for f in files if f[1] <= maxFileSize])
+    kept = {}
+    if changed is not None:
+        kept = keptBundles(packs_path, packsName, index_path, small, changed)
+    bundle_num = nextBundleNumber(packs_path)
+    used = set(kept.keys())
+    tar = None
+    with open(index_path + ".tmp", 'w') as index_fh:
+        index_fh.write("##bundles##\t%s\n" % packsName)
+        for bundle_name in sorted(kept.keys()):
+            for (path, offset, size) in kept[bundle_name]:
+                del small[path]
+                index_fh.write("%s\t%s\t%d\t%d\n" % (path, bundle_name, offset, size))
+        try:
+            for path in sorted(small.keys(), key=lambda p: (os.path.dirname(p), os.path.basename(p))):
+                if tar is None or tar.offset >= bundleSize:
+                    if tar is not None:
+                        tar.close()
+                    bundle_name = "pack%05d.tar" % bundle_num
+                    bundle_num += 1
+                    tar = tarfile.open(os.path.join(packs_path, bundle_name), 'w')
+                try:
+                    with open(os.path.join(root, path), 'rb') as in_fh:
+                        data = in_fh.read()
+                except IOError:
+                    continue
+                if len(data) != small[path]:
+                    # changed since it was hashed
+                    continue
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                tar.addfile(info, StringIO(data))
+                # the data ends the tar's offset (less padding to 512 bytes)
+                offset = tar.offset - ((len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                index_fh.write("%s\t%s\t%d\t%d\n" % (path, bundle_name, offset, len(data)))
+                used.add(bundle_name)
+        finally:
+            if tar is not None:
+                tar.close()
+    os.rename(index_path + ".tmp", index_path)
+    for name in os.listdir(packs_path):
+        if name not in used:
+            os.remove(os.path.join(packs_path, name))
+
+def keptBundles(packsPath, packsName, indexPath, small, changed):
+    """Work out which bundles of the current index can stay as they are
+
+    A bundle is kept if every member is still a small file of the same
+    size, nothing was touched in the member's folder and none of the
+    folders above it was replaced.
+    returns {bundle => [(path, data offset, size)]}
+    """
+    if not os.path.exists(indexPath):
+        return {}
+    with open(indexPath) as index_fh:
+        (packs_name, entries) = readBundleIndex(index_fh)
+    if packs_name != packsName:
+        return {}
+    touched_dirs = set([os.path.dirname(p) for p in changed])
+    members = {}
+    stale = set()
+    for (path, (bundle, offset, size)) in entries.items():
+        members.setdefault(bundle, []).append((path, offset, size))
+        if small.get(path) != size or os.path.dirname(path) in touched_dirs:
+            stale.add(bundle)
+            continue
+        head = path
+        while head != '':
+            if head in changed:
+                stale.add(bundle)
+                break
+            head = os.path.dirname(head)
+    kept = {}
+    for (bundle, bundle_members) in members.items():
+        if bundle not in stale and os.path.exists(os.path.join(packsPath, bundle)):
+            kept[bundle] = sorted(bundle_members, key=lambda m: m[1])
+    return kept
+
+def nextBundleNumber(packsPath):
+    """One more than the highest numbered bundle in packsPath"""
+    highest = -1
+    for name in os.listdir(packsPath):
+        if name.startswith("pack") and name.endswith(".tar"):
+            try:
+                highest = max(highest, int(name[4:-4]))
+            except ValueError:
+                pass
+    return highest + 1
+
+def readBundleIndex(index_fh, wanted=None):
+    """Parse a bundle index from an open file (or url) handle
+
+    Only paths in wanted are kept (all of them if wanted is None)
+    returns (packs folder, {path => (bundle, data offset, size)})
+    """
+    packs_name = None
+    entries = {}
+    for line in index_fh:
+        fields = line.rstrip("\n").split("\t")
+        if line[0] == "#":
+            packs_name = fields[1]
+        elif wanted is None or fields[0] in wanted:
+            entries[fields[0]] = (fields[1], int(fields[2]), int(fields[3]))
+    return (packs_name, entries)
+
+def planRuns(packsName, entries, jobs, maxGap=65536, minMembers=2):
+    """Work out which download jobs to take from bundles
+
+    Members of a bundle which lie within maxGap bytes of each other are
+    fetched as one byte range, as long as the range covers at least
+    minMembers files we need. Anything else is left to be fetched alone.
+    returns ([BundleRun], remaining jobs)
+    """
+    by_bundle = {}
+    remaining = []
+    for job in jobs:
+        if job[0] in entries:
+            (bundle, offset, size) = entries[job[0]]
+            by_bundle.setdefault(bundle, []).append(job + (offset, size))
+        else:
+            remaining.append(job)
+    runs = []
+    for bundle in sorted(by_bundle.keys()):
+        members = sorted(by_bundle[bundle], key=lambda m: m[3])
+        group = [members[0]]
+        for member in members[1:] + [None]:
+            if member is not None and member[3] - (group[-1][3] + group[-1][4]) <= maxGap:
+                group.append(member)
+                continue
+            if len(group) >= minMembers:
+                runs.append(BundleRun(packsName + "/" + bundle, group))
+            else:
+                remaining.extend([m[:3] for m in group])
+            group = [member]
+    return (runs, remaining)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
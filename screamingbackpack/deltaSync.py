@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    deltaSync.py                                                             #
+#                                                                             #
+#    Per-file block signatures used to fetch only the changed parts of files  #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__SIGNATURES__ = ".blocks"   # suffix of the sidecar holding block signatures
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+
+# local includes
+from screamingbackpack.hashing import newHasher, __DEFAULT_HASH__
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def blockHashes(fileName, blockSize, algorithm=__DEFAULT_HASH__):
+    """Hash a file as a whole and as a list of fixed size blocks
+
+    Both are computed from a single read of the file.
+    returns (digest, [block digests])
+    """
+    hasher = newHasher(algorithm)
+    blocks = []
+    with open(fileName, 'rb') as fh:
+        buf = fh.read(blockSize)
+        while len(buf) > 0:
+            hasher.update(buf)
+            block_hasher = newHasher(algorithm)
+            block_hasher.update(buf)
+            blocks.append(block_hasher.hexdigest())
+            buf = fh.read(blockSize)
+    return (hasher.hexdigest(), blocks)
+
+def writeSignatures(fileName, blockSize, signatures, algorithm=__DEFAULT_HASH__):
+    """Write the signature sidecar
+
+    signatures is a list of (path, [block digests]) in manifest order.
+    The file is written under a temporary name and renamed into place
+    """
+    tmp_name = fileName + ".tmp"
+    with open(tmp_name, 'w') as sig_fh:
+        if algorithm == __DEFAULT_HASH__:
+            sig_fh.write("##blocks##\t%d\n" % blockSize)
+        else:
+            sig_fh.write("##blocks##\t%d\t%s\n" % (blockSize, algorithm))
+        for (path, blocks) in signatures:
+            sig_fh.write("%s\t%s\n" % (path, ",".join(blocks)))
+    os.rename(tmp_name, fileName)
+
+def readSignatures(sig_fh, wanted=None):
+    """Parse a signature sidecar from an open file (or url) handle
+
+    Only paths in wanted are kept (all of them if wanted is None) so that
+    large sidecars never need to be held in memory.
+    returns (blockSize, {path => [block digests]}, algorithm)
+    """
+    block_size = 0
+    algorithm = __DEFAULT_HASH__
+    signatures = {}
+    for line in sig_fh:
+        fields = line.rstrip("\n").split("\t")
+        if line[0] == "#":
+            block_size = int(fields[1])
+            if len(fields) > 2:
+                algorithm = fields[2]
+        elif wanted is None or fields[0] in wanted:
+            signatures[fields[0]] = fields[1].split(",")
+    return (block_size, signatures, algorithm)
+
+def planDelta(localBlocks, remoteBlocks, blockSize, size):
+    """Work out how to rebuild a file from an old copy plus remote ranges
+
+    Matching blocks may come from anywhere in the old copy, so blocks that
+    moved are reused too. Neighbouring missing blocks are coalesced into
+    a single range.
+    returns a list of ('local', offset, length) and ('remote', offset, length)
+    """
+    local_index = {}
+    for i in range(len(localBlocks) - 1, -1, -1):
+        local_index[localBlocks[i]] = i * blockSize
+    plan = []
+    for (i, block) in enumerate(remoteBlocks):
+        offset = i * blockSize
+        length = min(blockSize, size - offset)
+        if block in local_index:
+            plan.append(('local', local_index[block], length))
+        elif len(plan) > 0 and plan[-1][0] == 'remote':
+            plan[-1] = ('remote', plan[-1][1], plan[-1][2] + length)
+        else:
+            plan.append(('remote', offset, length))
+    return plan
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
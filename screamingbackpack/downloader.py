@@ -0,0 +1,712 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    downloader.py                                                            #
+#                                                                             #
+#    Fetch files from a source using a pool of persistent connections         #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__PARTIAL__ = ".sbpart"      # suffix for files which are still being downloaded
+__PARTIAL_KINDS__ = ["", ".seg", ".reuse"]  # whole file, segmented and local copy partials
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import time
+import socket
+import threading
+import httplib
+import urllib
+import urlparse
+import Queue
+
+# local includes
+from screamingbackpack.deltaSync import blockHashes, planDelta
+from screamingbackpack.hashing import newHasher, hashFile
+from screamingbackpack.bundles import BundleRun
+from screamingbackpack.mirrors import Mirror, Segment, SegmentedFile, allocateConnections, __SEGMENT_SIZE__, __MIN_STEAL__
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def partialTargets(name):
+    """Names of the files a partial (".<name>[.seg|.reuse].sbpart") could become
+
+    ".a.seg.sbpart" could belong to "a" or "a.seg", so there may be more than
+    one. Empty for anything which isn't named like one of our partials
+    """
+    if not name.startswith(".") or not name.endswith(__PARTIAL__):
+        return []
+    base = name[1:-len(__PARTIAL__)]
+    return [base[:len(base) - len(kind)] for kind in __PARTIAL_KINDS__ if base.endswith(kind) and len(base) > len(kind)]
+
+class DownloadError(Exception):
+    """Raised when a single file could not be fetched"""
+    pass
+
+class Connection(object):
+    """A keep-alive connection to the host serving the source files
+
+    Each worker owns one of these and reuses it for every file it fetches.
+    basePath is the path of the source on that host
+    """
+    def __init__(self, scheme, netloc, timeout=30, basePath=""):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.basePath = basePath
+        self.conn = None
+
+    def connect(self):
+        """Open a fresh connection (closing any stale one)"""
+        self.close()
+        if self.scheme == 'https':
+            self.conn = httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        else:
+            self.conn = httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def request(self, path, headers=None):
+        """Issue a GET and return the response
+
+        The server may have dropped an idle keep-alive connection so we
+        reconnect and retry exactly once before giving up
+        """
+        if headers is None:
+            headers = {}
+        for attempt in [0, 1]:
+            if self.conn is None:
+                self.connect()
+            try:
+                self.conn.request("GET", path, headers=headers)
+                return self.conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt == 1:
+                    raise
+
+class LimitedReader(object):
+    """Read at most size bytes from a file like object"""
+    def __init__(self, fh, size):
+        self.fh = fh
+        self.remaining = size
+
+    def read(self, amount):
+        buf = self.fh.read(min(amount, self.remaining))
+        self.remaining -= len(buf)
+        return buf
+
+class Downloader(object):
+    """Fetch many files from one source using a bounded pool of workers
+
+    source is either a URL (ending in '/') or a local directory (ending in
+    the path separator), exactly as returned by ManifestManager.diffManifests
+
+    mirrors are Mirrors (see mirrors.py) serving the same files, fastest
+    first. The connections are shared between them and a file which can't
+    be fetched from one is tried on the others. Files listed in sizes which
+    are larger than segmentSize are split into ranges fetched in parallel
+    """
+    def __init__(self, source, connections=4, timeout=30, blocksize=65536, retries=3, hashAlgorithm='sha256', progress=None, mirrors=None, segmentSize=__SEGMENT_SIZE__):
+        self.source = source
+        self.connections = max(1, connections)
+        self.timeout = timeout
+        self.blocksize = blocksize
+        self.retries = retries              # times to resume an interrupted transfer
+        self.hashAlgorithm = hashAlgorithm
+        self.signatureSize = 0              # block size used by the source's block signatures
+        self.signatureAlgorithm = hashAlgorithm # hash used by the source's block signatures
+        self.signatures = {}                # {path => ([block digests], size)} for delta sync
+        self.bytesReused = 0                # bytes taken from old local copies by delta sync
+        self.progress = progress            # callback(phase, files, total files, bytes, total bytes)
+        self.filesDone = 0                  # files fetched by the last fetchAll
+        self.bytesDone = 0                  # bytes transferred by the last fetchAll
+        self.totalFiles = None
+        self.totalBytes = None
+        self.lock = threading.Lock()
+        url = urlparse.urlsplit(source)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.basePath = url.path
+        if mirrors is None or len(mirrors) == 0:
+            mirrors = [Mirror(source)]
+        self.mirrors = mirrors
+        self.segmentSize = segmentSize
+        self.sizes = {}                     # {path => size} of files which may be split between mirrors
+        self.filesSegmented = 0             # files fetched in segments by the last fetchAll
+        self.down = set()                   # (host, path) of mirrors which have stopped answering
+        self.inflight = set()               # Segments being fetched right now
+        self.rates = {}                     # {(host, path) => (bytes, seconds)} fetched as segments
+
+    def isHttp(self):
+        return self.scheme in ['http', 'https']
+
+    def fetchAll(self, jobs, totalBytes=None, runs=()):
+        """Fetch every (relative_path, local_path, hash) in jobs
+
+        hash may be None to skip verification. returns a list of
+        (relative_path, error message) for any files which could not be
+        fetched. One failure does not stop the others. totalBytes is only
+        used for progress reports
+
+        runs are BundleRuns (see bundles.py) which are fetched first. Any
+        of their members which can't be taken from the bundle are fetched
+        on their own instead
+        """
+        self.filesDone = 0
+        self.bytesDone = 0
+        self.filesSegmented = 0
+        self.totalFiles = len(jobs) + sum([len(r.members) for r in runs])
+        self.totalBytes = totalBytes
+        work = Queue.Queue()
+        items = list(runs)
+        for job in jobs:
+            items.extend(self.split(job))
+        for item in items:
+            work.put(item)
+        errors = []
+
+        def report(job, error):
+            if error is not None:
+                with self.lock:
+                    errors.append((job[0], error))
+
+        count = min(self.connections, len(items))
+        for i in range(count):
+            work.put(None)
+        threads = self.startWorkers(work, report, count)
+        for t in threads:
+            t.join()
+        return errors
+
+    def split(self, job):
+        """The work items for one job
+
+        That is the job itself unless it is a large file which can be
+        shared between mirrors, in which case it is its Segments
+        """
+        size = self.sizes.get(job[0])
+        if size is None or size <= self.segmentSize or self.segmentSize <= 0:
+            return [job]
+        if len(self.mirrors) < 2 or not self.isHttp() or job[0] in self.signatures:
+            return [job]
+        # not resumable like other partial files so it gets its own name
+        (head, tail) = os.path.split(job[1])
+        part_path = os.path.join(head, "." + tail + ".seg" + __PARTIAL__)
+        with open(part_path, 'wb') as part_fh:
+            part_fh.truncate(size)
+        return SegmentedFile(job, size, part_path, self.segmentSize).segments
+
+    def startWorkers(self, work, report, count=None):
+        """Start workers which fetch jobs (and BundleRuns) from the queue work
+
+        Each worker stops when it takes a None off the queue, so put one
+        there for every worker once all the jobs are in. report(job, error)
+        is called once for every file, with error None if it was fetched.
+        Workers are shared between the mirrors (see allocateConnections)
+        returns the worker threads
+        """
+        if count is None:
+            count = self.connections
+        threads = []
+        for mirror in allocateConnections(self.mirrors, count):
+            t = threading.Thread(target=self.worker, args=(work, report, mirror))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        return threads
+
+    def worker(self, work, report, mirror=None):
+        if mirror is None:
+            mirror = self.mirrors[0]
+        conn = None
+        if self.isHttp():
+            conn = self.connect(mirror)
+        try:
+            while True:
+                job = work.get()
+                if job is None:
+                    # help finish anything left on slower mirrors
+                    segment = self.steal(conn)
+                    while segment is not None:
+                        self.fetchSegment(conn, segment, report)
+                        segment = self.steal(conn)
+                    return
+                if conn is not None:
+                    conn = self.liveConnection(conn)
+                if isinstance(job, BundleRun):
+                    try:
+                        fallback = self.fetchRun(conn, job)
+                    except EnvironmentError:
+                        conn.close()
+                        fallback = job.jobs()
+                    for member in job.jobs():
+                        if member not in fallback:
+                            report(member, None)
+                    # whatever didn't come out of the bundle is fetched alone
+                    for fallback_job in fallback:
+                        self.fetchJob(conn, fallback_job, report)
+                elif isinstance(job, Segment):
+                    self.fetchSegment(conn, job, report)
+                else:
+                    self.fetchJob(conn, job, report)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def connect(self, mirror):
+        return Connection(mirror.scheme, mirror.netloc, timeout=self.timeout, basePath=mirror.basePath)
+
+    def tryMirrors(self, conn, action):
+        """Call action(connection) on this worker's mirror, then on each other one until it works
+
+        Partial files are kept between attempts so a transfer which stops
+        on one mirror is resumed on the next
+        """
+        try:
+            return action(conn)
+        except (DownloadError, EnvironmentError, httplib.HTTPException) as e:
+            if conn is not None:
+                # don't reuse a connection left mid-response
+                conn.close()
+                self.checkDown(conn, e)
+            error = e
+        if conn is None:
+            raise error
+        for mirror in self.mirrors:
+            key = (mirror.netloc, mirror.basePath)
+            if key == (conn.netloc, conn.basePath) or key in self.down:
+                continue
+            other = self.connect(mirror)
+            try:
+                return action(other)
+            except (DownloadError, EnvironmentError, httplib.HTTPException) as e:
+                self.checkDown(other, e)
+                error = e
+            finally:
+                other.close()
+        raise error
+
+    def checkDown(self, conn, error):
+        """Stop using a mirror which can't be reached (only if there are others)"""
+        if isinstance(error, socket.error) and len(self.mirrors) > 1:
+            with self.lock:
+                self.down.add((conn.netloc, conn.basePath))
+
+    def liveConnection(self, conn):
+        """Move a worker off a mirror which has stopped answering"""
+        if (conn.netloc, conn.basePath) not in self.down:
+            return conn
+        for mirror in self.mirrors:
+            if (mirror.netloc, mirror.basePath) not in self.down:
+                conn.close()
+                return self.connect(mirror)
+        return conn
+
+    def fetchJob(self, conn, job, report):
+        (rel_path, local_path, hashd) = job
+        try:
+            self.tryMirrors(conn, lambda c: self.fetch(c, rel_path, local_path, hashd))
+        except (DownloadError, EnvironmentError, httplib.HTTPException) as e:
+            report(job, str(e))
+            return
+        with self.lock:
+            self.filesDone += 1
+        self.advance(0)
+        report(job, None)
+
+    def fetchSegment(self, conn, segment, report):
+        """Fetch one range of a large file into place
+
+        The last segment to finish checks the whole file against the
+        manifest. If it doesn't match the file is fetched again in one go
+        """
+        parent = segment.parent
+        error = None
+        with self.lock:
+            self.inflight.add(segment)
+        try:
+            self.tryMirrors(conn, lambda c: self.fetchRange(c, segment))
+        except (DownloadError, EnvironmentError, httplib.HTTPException) as e:
+            error = str(e)
+        finally:
+            with self.lock:
+                self.inflight.discard(segment)
+        if not parent.finish(error):
+            return
+        if parent.error is None:
+            try:
+                if parent.job[2] is None or hashFile(parent.partPath, self.hashAlgorithm) == parent.job[2]:
+                    os.rename(parent.partPath, parent.job[1])
+                    with self.lock:
+                        self.filesDone += 1
+                        self.filesSegmented += 1
+                    self.advance(0)
+                    report(parent.job, None)
+                    return
+            except EnvironmentError as e:
+                parent.error = str(e)
+        if os.path.exists(parent.partPath):
+            os.remove(parent.partPath)
+        if parent.error is not None:
+            report(parent.job, parent.error)
+        else:
+            # one of the mirrors sent something else
+            self.fetchJob(conn, parent.job, report)
+
+    def fetchRange(self, conn, segment):
+        """Fetch the rest of a segment into place in its file
+
+        Picks up from wherever an earlier attempt stopped. Stops early if
+        another worker takes over the end of the range (see steal)
+        """
+        parent = segment.parent
+        lock = parent.lock
+        with lock:
+            (start, end) = (segment.position, segment.end)
+        if start > end:
+            return
+        response = conn.request(conn.basePath + urllib.quote(parent.job[0]), {'Range': "bytes=%d-%d" % (start, end)})
+        if response.status != 206:
+            response.read()
+            raise DownloadError("HTTP %d %s, range requests not supported" % (response.status, response.reason))
+        began = time.time()
+        with lock:
+            segment.started = (began, segment.position)
+        try:
+            with open(parent.partPath, 'r+b') as out_fh:
+                while True:
+                    buf = response.read(self.blocksize)
+                    with lock:
+                        offset = segment.position
+                        amount = min(len(buf), segment.remaining())
+                        segment.position += amount
+                    if amount > 0:
+                        out_fh.seek(offset)
+                        out_fh.write(buf[:amount])
+                        self.advance(amount)
+                    if segment.remaining() <= 0:
+                        break
+                    if len(buf) == 0:
+                        raise httplib.IncompleteRead("%d of %d bytes" % (segment.position - start, end - start + 1))
+        finally:
+            segment.started = None
+            with self.lock:
+                (fetched, seconds) = self.rates.get((conn.netloc, conn.basePath), (0, 0.0))
+                self.rates[(conn.netloc, conn.basePath)] = (fetched + segment.position - start, seconds + time.time() - began)
+        if not response.isclosed():
+            # the end was taken over so the rest of the response isn't wanted
+            conn.close()
+
+    def steal(self, conn):
+        """Take over the end of the unfinished segment which will take longest
+
+        Only segments going slower than this worker's mirror has managed
+        (or, before it has managed anything, less than half the best rate
+        seen) are split
+        returns the new Segment or None
+        """
+        if conn is None:
+            return None
+        with self.lock:
+            segments = list(self.inflight)
+            (fetched, seconds) = self.rates.get((conn.netloc, conn.basePath), (0, 0.0))
+        rates = [(s, s.rate()) for s in segments]
+        rates = [(s, r) for (s, r) in rates if r is not None and s.remaining() >= __MIN_STEAL__]
+        if len(rates) == 0:
+            return None
+        if seconds > 0:
+            limit = fetched / seconds
+        else:
+            limit = max([r for (s, r) in rates]) / 2
+        slower = [(s.remaining() / max(r, 1.0), s) for (s, r) in rates if r < limit]
+        if len(slower) == 0:
+            return None
+        return max(slower)[1].steal()
+
+    def partialPath(self, local_path):
+        """Where a file lives while it is being downloaded
+
+        The name is fixed so an interrupted download can be resumed by a
+        later run. It sits in the same directory so the final rename is atomic
+        """
+        (head, tail) = os.path.split(local_path)
+        return os.path.join(head, "." + tail + __PARTIAL__)
+
+    def fetch(self, conn, rel_path, local_path, hashd=None):
+        """Fetch a single file into local_path
+
+        The data is hashed as it arrives and only renamed over local_path
+        once it matches hashd. Dropped connections are resumed from the
+        end of the partial file using Range requests. A partial file left
+        by an older version of the file fails the hash check, so it is
+        thrown away and the file fetched again once from the start
+        """
+        part_path = self.partialPath(local_path)
+        if conn is not None and rel_path in self.signatures and os.path.exists(local_path) and not os.path.exists(part_path):
+            try:
+                if self.fetchDelta(conn, rel_path, local_path, hashd):
+                    return
+            except (DownloadError, httplib.HTTPException, socket.error):
+                # fall back to fetching the whole file
+                conn.close()
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+        resumed = conn is not None and os.path.exists(part_path)
+        try:
+            hasher = self.fetchWhole(conn, rel_path, part_path)
+        except DownloadError:
+            # a 416 means the partial file was longer than the file is now
+            # and it has been removed, anything else is a real failure
+            if not resumed or os.path.exists(part_path):
+                raise
+            resumed = False
+            hasher = self.fetchWhole(conn, rel_path, part_path)
+        if hashd is not None and hasher.hexdigest() != hashd and resumed:
+            # the partial file was left by an older version of the file
+            os.remove(part_path)
+            hasher = self.fetchWhole(conn, rel_path, part_path)
+        if hashd is not None and hasher.hexdigest() != hashd:
+            os.remove(part_path)
+            raise DownloadError("%s hash does not match the source manifest" % self.hashAlgorithm)
+        os.rename(part_path, local_path)
+
+    def fetchWhole(self, conn, rel_path, part_path):
+        """Fetch rel_path into part_path, resuming whatever is already there
+
+        returns the hasher fed with the whole file
+        """
+        for attempt in range(self.retries + 1):
+            hasher = newHasher(self.hashAlgorithm)
+            offset = 0
+            if conn is not None and os.path.exists(part_path):
+                # pick up where the last attempt stopped
+                offset = self.hashInto(hasher, part_path)
+            try:
+                if conn is None:
+                    offset = 0
+                    self.fetchLocal(rel_path, part_path, hasher)
+                else:
+                    (offset, hasher) = self.fetchHttp(conn, rel_path, part_path, hasher, offset)
+                return hasher
+            except (httplib.HTTPException, socket.error) as e:
+                if conn is None:
+                    raise
+                conn.close()
+                if attempt == self.retries:
+                    raise DownloadError("transfer interrupted (%s), partial file kept for resume" % e)
+
+    def fetchDelta(self, conn, rel_path, local_path, hashd=None):
+        """Rebuild a modified file from its old copy plus the changed ranges
+
+        returns False if the block signatures show there is nothing to gain
+        """
+        (remote_blocks, size) = self.signatures[rel_path]
+        local_blocks = blockHashes(local_path, self.signatureSize, self.signatureAlgorithm)[1]
+        plan = planDelta(local_blocks, remote_blocks, self.signatureSize, size)
+        remote_bytes = sum([p[2] for p in plan if p[0] == 'remote'])
+        if remote_bytes >= size:
+            return False
+
+        part_path = self.partialPath(local_path)
+        hasher = newHasher(self.hashAlgorithm)
+        url_path = conn.basePath + urllib.quote(rel_path)
+        with open(local_path, 'rb') as old_fh:
+            with open(part_path, 'wb') as out_fh:
+                for (where, offset, length) in plan:
+                    if where == 'local':
+                        old_fh.seek(offset)
+                        buf = old_fh.read(length)
+                        out_fh.write(buf)
+                        hasher.update(buf)
+                    else:
+                        response = conn.request(url_path, {'Range': "bytes=%d-%d" % (offset, offset + length - 1)})
+                        if response.status != 206:
+                            raise DownloadError("HTTP %d %s, range requests not supported" % (response.status, response.reason))
+                        received = self.stream(response, out_fh, hasher)
+                        if received != length:
+                            raise httplib.IncompleteRead("%d of %d bytes" % (received, length))
+
+        if hashd is not None and hasher.hexdigest() != hashd:
+            raise DownloadError("%s hash of rebuilt file does not match the source manifest" % self.hashAlgorithm)
+        os.rename(part_path, local_path)
+        with self.lock:
+            self.bytesReused += size - remote_bytes
+        return True
+
+    def fetchRun(self, conn, run):
+        """Fetch one byte range of a bundle and take the members out of it
+
+        Each member is hashed and renamed into place on its own.
+        returns the jobs for any members which still need to be fetched
+        """
+        fallback = []
+        pending = list(run.members)
+        try:
+            response = conn.request(conn.basePath + urllib.quote(run.bundle),
+                                    {'Range': "bytes=%d-%d" % (run.start, run.end)})
+            if response.status == 206:
+                position = run.start
+            elif response.status == 200:
+                # the server sent the whole bundle
+                position = 0
+            else:
+                response.read()
+                return run.jobs()
+            while len(pending) > 0:
+                (rel_path, local_path, hashd, offset, size) = pending[0]
+                self.skip(response, offset - position)
+                part_path = self.partialPath(local_path)
+                hasher = newHasher(self.hashAlgorithm)
+                with open(part_path, 'wb') as out_fh:
+                    received = self.stream(LimitedReader(response, size), out_fh, hasher)
+                position = offset + received
+                if received != size:
+                    os.remove(part_path)
+                    raise httplib.IncompleteRead("%d of %d bytes" % (received, size))
+                pending.pop(0)
+                if hashd is not None and hasher.hexdigest() != hashd:
+                    # the bundle is older (or newer) than the manifest
+                    os.remove(part_path)
+                    fallback.append((rel_path, local_path, hashd))
+                    continue
+                os.rename(part_path, local_path)
+                with self.lock:
+                    self.filesDone += 1
+            # leave the connection ready for the next request
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+        return fallback + [m[:3] for m in pending]
+
+    def skip(self, response, amount):
+        """Read and throw away amount bytes"""
+        while amount > 0:
+            buf = response.read(min(amount, self.blocksize))
+            if len(buf) == 0:
+                raise httplib.IncompleteRead("bundle ended early")
+            amount -= len(buf)
+
+    def fetchLocal(self, rel_path, part_path, hasher):
+        """Copy from a local directory (or anything else urllib can open)"""
+        if self.scheme == '' or len(self.scheme) == 1:
+            # a local directory (a one letter scheme is a windows drive)
+            in_fh = open(os.path.join(self.source, rel_path), 'rb')
+        else:
+            # something httplib can't speak (e.g. ftp)
+            in_fh = urllib.urlopen(self.source + rel_path)
+        try:
+            with open(part_path, 'wb') as out_fh:
+                self.stream(in_fh, out_fh, hasher)
+        finally:
+            in_fh.close()
+
+    def fetchHttp(self, conn, rel_path, part_path, hasher, offset):
+        """GET rel_path, appending to part_path if the server honours Range
+
+        returns the (possibly restarted) offset and hasher
+        """
+        headers = {}
+        if offset > 0:
+            headers['Range'] = "bytes=%d-" % offset
+        response = conn.request(conn.basePath + urllib.quote(rel_path), headers)
+        if response.status == 206:
+            mode = 'ab'
+        elif response.status == 200:
+            # either a fresh download or the server ignored the Range
+            mode = 'wb'
+            offset = 0
+            hasher = newHasher(self.hashAlgorithm)
+        else:
+            response.read()
+            if response.status == 416:
+                # the partial file is no use to us, start again next time
+                os.remove(part_path)
+            raise DownloadError("HTTP %d %s" % (response.status, response.reason))
+        with open(part_path, mode) as out_fh:
+            received = self.stream(response, out_fh, hasher)
+        # httplib quietly returns short reads when the connection drops
+        expected = response.getheader('content-length')
+        if expected is not None and received < int(expected):
+            raise httplib.IncompleteRead("%d of %s bytes" % (received, expected))
+        return (offset, hasher)
+
+    def stream(self, in_fh, out_fh, hasher):
+        """Copy in_fh to out_fh, hashing everything on the way past (unless hasher is None)
+
+        returns the number of bytes copied
+        """
+        length = 0
+        buf = in_fh.read(self.blocksize)
+        while len(buf) > 0:
+            out_fh.write(buf)
+            if hasher is not None:
+                hasher.update(buf)
+            length += len(buf)
+            self.advance(len(buf))
+            buf = in_fh.read(self.blocksize)
+        return length
+
+    def advance(self, amount):
+        """Count transferred bytes and pass them on to the progress callback"""
+        with self.lock:
+            self.bytesDone += amount
+            if self.progress is not None:
+                self.progress('download', self.filesDone, self.totalFiles, self.bytesDone, self.totalBytes)
+
+    def hashInto(self, hasher, fileName):
+        """Feed an existing file into hasher and return its length"""
+        length = 0
+        with open(fileName, 'rb') as fh:
+            buf = fh.read(self.blocksize)
+            while len(buf) > 0:
+                hasher.update(buf)
+                length += len(buf)
+                buf = fh.read(self.blocksize)
+        return length
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
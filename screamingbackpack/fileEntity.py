@@ -41,8 +41,11 @@ __status__ = "Beta"
 # system includes
 import sys
 import os
+import stat
+import binascii
 
 # local includes
+from screamingbackpack.hashing import hashFile
 
 ###############################################################################
 ###############################################################################
@@ -50,7 +53,14 @@ import os
 ###############################################################################
 
 class FileEntity(object):
-    """Basic file entity"""
+    """Basic file entity
+
+    Millions of these can be held at once so they are kept small: no
+    per-instance dict, digests stored as raw bytes, integer sizes and
+    interned directory paths (shared by every entity in a directory)
+    """
+    __slots__ = ['name', 'path', 'parent', 'digest', 'size']
+
     def __init__(self,
                  name,      # the name of the entity on the file system ( Full path to root dir if id: ROOT)
                  path,      # the local path to this entity
@@ -59,25 +69,73 @@ class FileEntity(object):
                  size       # size of the file in bytes
                  ):
         self.name = name
-        self.path=path
+        if type(path) is str:
+            # intern() only takes byte strings in python 2
+            path = intern(path)
+        self.path = path
         self.parent = parent
         self.hashd = hashd
-        self.size = size
+        self.size = int(size)
+
+    @classmethod
+    def fromManifestLine(cls, line, parent=None):
+        """Make an entity from a "path hash size" manifest line"""
+        fields = line.rstrip().split("\t")
+        (path, name) = os.path.split(fields[0])
+        return cls(name, path, parent, fields[1], fields[2])
+
+    def _getHashd(self):
+        if len(self.digest) > 1:
+            return binascii.hexlify(self.digest)
+        return self.digest
+
+    def _setHashd(self, hashd):
+        # "-" (folders) and "?" (not hashed yet) are kept as they are
+        if hashd[0] == '-':
+            # merkle folder hashes are only needed by the diff
+            self.digest = '-'
+        elif len(hashd) > 1:
+            self.digest = binascii.unhexlify(hashd)
+        else:
+            self.digest = hashd
+
+    hashd = property(_getHashd, _setHashd)
 
     def getFullPath(self):
         """get the full path to this entity"""
         if self.parent == None:
             return ""
         else:
-            return os.path.join(self.parent.getFullPath(), self.name)
+            return os.path.join(self.path, self.name)
 
-    def checkIntegrity(self):
-        """Check the file for corruption"""
-        if self.type == 'dir':
-            return True
-        else:
-            # check the hashd and compare against the recorded MD5
-            return True
+    def checkIntegrity(self, root, rehash=True, hasher=None):
+        """Check the file under root for corruption
+
+        Existence and size are checked with a single stat. If rehash is
+        true the file is also hashed (with hasher if given, sha256
+        otherwise) and compared against the recorded hash.
+        returns one of 'ok', 'missing', 'size' or 'hash'
+        """
+        full_path = os.path.join(root, self.path, self.name)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return 'missing'
+        if self.hashd[0] == '-':
+            if stat.S_ISDIR(st.st_mode):
+                return 'ok'
+            return 'missing'
+        if not stat.S_ISREG(st.st_mode):
+            return 'missing'
+        if st.st_size != self.size:
+            return 'size'
+        if rehash:
+            if hasher is None:
+                hasher = hashFile
+            digest = hasher(full_path)
+            if digest != self.hashd:
+                return 'hash'
+        return 'ok'
 
     def __str__(self):
         if self.parent is not None:
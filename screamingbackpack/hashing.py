@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    hashing.py                                                               #
+#                                                                             #
+#    Hash algorithms and file read strategies used by manifests               #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__DEFAULT_HASH__ = "sha256"         # used by any manifest which doesn't declare one
+__DEFAULT_READ__ = "buffered"
+__READ_STRATEGIES__ = ["buffered", "readinto", "mmap"]
+__READ_SIZE__ = 1024 * 1024
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import mmap
+import hashlib
+
+# local includes
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def newHasher(algorithm=__DEFAULT_HASH__):
+    """Make a fresh hash object
+
+    Anything hashlib knows about can be used. blake2b / blake2s come from
+    hashlib when available (python 3.6+) or from the pyblake2 package.
+    raises ValueError for unknown algorithms
+    """
+    if algorithm in ['blake2b', 'blake2s']:
+        try:
+            return getattr(hashlib, algorithm)()
+        except AttributeError:
+            try:
+                import pyblake2
+            except ImportError:
+                raise ValueError("%s needs python 3.6+ or the pyblake2 package" % algorithm)
+            return getattr(pyblake2, algorithm)()
+    return hashlib.new(algorithm)
+
+def hashFile(fileName, algorithm=__DEFAULT_HASH__, strategy=__DEFAULT_READ__, blocksize=__READ_SIZE__):
+    """Hash a file and return the hex digest
+
+    strategy is one of:
+        buffered - large buffered reads
+        readinto - read into a single reused buffer (no per-block allocation)
+        mmap     - map the file and hash it in one go
+    """
+    hasher = newHasher(algorithm)
+    with open(fileName, 'rb') as fh:
+        if strategy == 'mmap':
+            if os.fstat(fh.fileno()).st_size > 0:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    try:
+                        hasher.update(mapped)
+                    except TypeError:
+                        # pyblake2 can't take an mmap directly
+                        for start in xrange(0, len(mapped), blocksize):
+                            hasher.update(mapped[start:start + blocksize])
+                finally:
+                    mapped.close()
+        elif strategy == 'readinto':
+            buf = bytearray(blocksize)
+            view = memoryview(buf)
+            length = fh.readinto(buf)
+            while length > 0:
+                hasher.update(view[:length])
+                length = fh.readinto(buf)
+        elif strategy == 'buffered':
+            buf = fh.read(blocksize)
+            while len(buf) > 0:
+                hasher.update(buf)
+                buf = fh.read(blocksize)
+        else:
+            raise ValueError("unknown read strategy %s" % strategy)
+    return hasher.hexdigest()
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    instrumentation.py                                                       #
+#                                                                             #
+#    Phase timers, counters and progress reporting                            #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# local includes
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class Metrics(object):
+    """Accumulate time spent in named phases and named counters
+
+    Phases may nest (e.g. rebuild includes walk and hash) so the timers
+    don't add up to the total. Counters are safe to bump from any thread.
+    """
+    def __init__(self):
+        self.timers = {}                    # {phase => seconds}
+        self.counters = {}                  # {name => count}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as phase name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.timers[name] = self.timers.get(name, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def toDict(self):
+        with self.lock:
+            return {'wall_s': round(time.time() - self.started, 4),
+                    'timers': dict([(k, round(v, 4)) for (k, v) in self.timers.items()]),
+                    'counters': dict(self.counters)}
+
+class ProgressBar(object):
+    """Throttled one line progress display with rate and ETA
+
+    An instance can be passed anywhere a progress callback is accepted:
+
+        callback(phase, files done, total files, bytes done, total bytes)
+
+    Totals may be None when they aren't known. Nothing is drawn unless the
+    stream is a terminal (or force is set)
+    """
+    def __init__(self, stream=None, interval=0.5, force=False):
+        if stream is None:
+            stream = sys.stderr
+        self.stream = stream
+        self.interval = interval
+        self.enabled = force or (hasattr(stream, 'isatty') and stream.isatty())
+        self.phase = None
+        self.phaseStart = 0.0
+        self.lastDraw = 0.0
+        self.width = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, phase, files, totalFiles=None, done=0, totalBytes=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            now = time.time()
+            if phase != self.phase:
+                self.end()
+                self.phase = phase
+                self.phaseStart = now
+                # the first rate would be meaningless
+                self.lastDraw = now
+            finished = totalFiles is not None and files >= totalFiles
+            if not finished and now - self.lastDraw < self.interval:
+                return
+            self.lastDraw = now
+            self.draw(now, files, totalFiles, done, totalBytes)
+            if finished:
+                self.end()
+
+    def draw(self, now, files, totalFiles, done, totalBytes):
+        elapsed = max(now - self.phaseStart, 1e-6)
+        line = "%-8s %d" % (self.phase, files)
+        if totalFiles is not None:
+            line += "/%d" % totalFiles
+        line += " files"
+        if totalBytes:
+            line += "  %s/%s  %s/s" % (formatData(done), formatData(totalBytes), formatData(done / elapsed))
+            fraction = float(done) / totalBytes
+        else:
+            line += "  %s  %.1f files/s" % (formatData(done), files / elapsed)
+            fraction = None
+            if totalFiles:
+                fraction = float(files) / totalFiles
+        if fraction is not None and fraction > 0:
+            line += "  ETA %s" % formatSeconds(elapsed / fraction - elapsed)
+        self.stream.write("\r" + line.ljust(self.width))
+        self.stream.flush()
+        self.width = len(line)
+
+    def end(self):
+        """Leave the current line as it is and move to the next"""
+        if self.phase is not None and self.width > 0:
+            self.stream.write("\n")
+            self.stream.flush()
+        self.phase = None
+        self.width = 0
+
+def formatData(amount):
+    """Pretty print file sizes"""
+    if amount < 1024*1024:
+        return "%d B" % amount
+    elif amount < 1024*1024*1024:
+        return "%0.2f MB" % (float(amount)/(1024.*1024.))
+    elif amount < 1024*1024*1024*1024:
+        return "%0.2f GB" % (float(amount)/(1024.*1024.*1024.))
+    return "%0.2f TB" % (float(amount)/(1024.*1024.*1024.*1024.))
+
+def formatSeconds(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    localReuse.py                                                            #
+#                                                                             #
+#    Satisfy downloads from content that is already on local disks            #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# ioctl request which clones one file's extents into another (linux)
+FICLONE = 0x40049409
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import errno
+import shutil
+
+# local includes
+from screamingbackpack.hashing import newHasher, hashFile
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class LocalReuser(object):
+    """Find local copies of content by hash and place them where they are needed
+
+    Candidates come from the local manifest and, optionally, a shared content
+    store laid out as <store>/<hash[:2]>/<hash>. Every candidate is re-hashed
+    before it is used, so a stale manifest can never put bad data in place.
+
+    mode is one of:
+        hardlink - link to the existing copy (falls back to copy)
+        reflink  - copy-on-write clone where supported (falls back to copy)
+        copy     - plain copy
+    """
+    def __init__(self, root, mode='reflink', store=None, hashAlgorithm='sha256', blocksize=65536):
+        self.root = root
+        self.mode = mode
+        self.store = store
+        self.hashAlgorithm = hashAlgorithm
+        self.blocksize = blocksize
+        self.index = {}                     # {hash => [relative paths]}
+        self.bytesReused = 0
+
+    def indexManifest(self, lines, wanted=None):
+        """Index the files in a local manifest whose hash is in wanted
+
+        Every file is indexed if wanted is None
+        """
+        for line in lines:
+            if line[0] != "#":
+                fields = line.rstrip().split("\t")
+                if fields[1][0] == '-':
+                    continue
+                if wanted is None or fields[1] in wanted:
+                    self.index.setdefault(fields[1], []).append(fields[0])
+
+    def storePath(self, hashd):
+        return os.path.join(self.store, hashd[:2], hashd)
+
+    def candidates(self, hashd):
+        """Full paths of every local file which should hold this content"""
+        paths = [os.path.join(self.root, p) for p in self.index.get(hashd, [])]
+        if self.store is not None:
+            paths.append(self.storePath(hashd))
+        return [p for p in paths if os.path.isfile(p)]
+
+    def reuse(self, hashd, target, tmpPath):
+        """Put a verified local copy of hashd at target
+
+        returns True on success, False if the content has to be downloaded
+        """
+        for source in self.candidates(hashd):
+            if os.path.abspath(source) == os.path.abspath(target):
+                continue
+            try:
+                if self.place(source, tmpPath) == hashd:
+                    os.rename(tmpPath, target)
+                    self.bytesReused += os.path.getsize(target)
+                    return True
+            except EnvironmentError:
+                pass
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        return False
+
+    def place(self, source, dest):
+        """Link, clone or copy source to dest and return the hash of the result"""
+        if self.mode == 'hardlink':
+            try:
+                digest = self.hashOf(source)
+                os.link(source, dest)
+                return digest
+            except OSError as e:
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                    raise
+        elif self.mode == 'reflink':
+            if self.clone(source, dest):
+                return self.hashOf(dest)
+        return self.copy(source, dest)
+
+    def clone(self, source, dest):
+        """Try a copy-on-write clone, returns False if it isn't supported"""
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        with open(source, 'rb') as in_fh:
+            with open(dest, 'wb') as out_fh:
+                try:
+                    fcntl.ioctl(out_fh.fileno(), FICLONE, in_fh.fileno())
+                    return True
+                except IOError:
+                    return False
+
+    def copy(self, source, dest):
+        """Copy source to dest, hashing on the way past"""
+        hasher = newHasher(self.hashAlgorithm)
+        with open(source, 'rb') as in_fh:
+            with open(dest, 'wb') as out_fh:
+                buf = in_fh.read(self.blocksize)
+                while len(buf) > 0:
+                    out_fh.write(buf)
+                    hasher.update(buf)
+                    buf = in_fh.read(self.blocksize)
+        shutil.copystat(source, dest)
+        return hasher.hexdigest()
+
+    def hashOf(self, fileName):
+        return hashFile(fileName, self.hashAlgorithm)
+
+    def addToStore(self, hashd, path):
+        """Share a freshly downloaded file through the content store"""
+        if self.store is None:
+            return
+        store_path = self.storePath(hashd)
+        if os.path.exists(store_path):
+            return
+        try:
+            os.makedirs(os.path.dirname(store_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = store_path + ".tmp%d" % os.getpid()
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            # different file system
+            shutil.copyfile(path, tmp_path)
+        os.rename(tmp_path, store_path)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -38,6 +38,10 @@ __version__ = "0.2.3"
 ###############################################################################
 
 __MANIFEST__ = ".dmanifest"
+__STATCACHE__ = ".stat"      # suffix of the sidecar stat cache used by incremental builds
+__HASH_BATCH__ = 4096        # files handed to the hashing workers at a time
+__SOURCECACHE__ = ".source"  # suffix of the local copy of the last fetched source manifest
+__TEMPORARY__ = ".tmp"       # suffix of a manifest while it is being written
 
 ###############################################################################
 ###############################################################################
@@ -46,14 +50,76 @@ __MANIFEST__ = ".dmanifest"
 
 # system includes
 import os
-import hashlib
 import urllib2
-import urllib
 import shutil
+import binascii
 import errno
+import stat
+import random
+import zlib
+import socket
+import httplib
+import tempfile
+from itertools import izip
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # local includes
 from screamingbackpack.fileEntity import FileEntity as FE
+from screamingbackpack.downloader import Downloader, partialTargets, __PARTIAL__
+from screamingbackpack.deltaSync import blockHashes, writeSignatures, readSignatures, __SIGNATURES__
+from screamingbackpack.binaryManifest import BinaryManifest, writeBinaryManifest, __BINARY__
+from screamingbackpack.localReuse import LocalReuser
+from screamingbackpack.bundles import writeBundles, readBundleIndex, planRuns, __BUNDLES__, __PACKS__
+from screamingbackpack.mirrors import probeMirrors, entriesDigest, __SEGMENT_SIZE__
+from screamingbackpack.instrumentation import Metrics, formatData
+from screamingbackpack.hashing import hashFile, newHasher, __DEFAULT_HASH__, __DEFAULT_READ__, __READ_STRATEGIES__, __READ_SIZE__
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class ManifestOrderError(Exception):
+    """Raised when a manifest is not sorted by path"""
+    pass
+
+def hashFileJob(job):
+    """Hash a file and return the digest
+
+    job is (fileName, algorithm, read strategy). Lives at module level so
+    that it can be shipped to worker processes
+    """
+    return hashFile(job[0], job[1], job[2])
+
+def verifyEntry(job):
+    """Check one manifest entry against the file system
+
+    job is (root, manifest line, rehash, algorithm, read strategy) so it
+    can be used with Pool.imap
+    returns (problem, path, whether the file was hashed)
+    """
+    (root, line, rehash, algorithm, strategy) = job
+    fe = FE.fromManifestLine(line)
+    hasher = lambda fileName: hashFile(fileName, algorithm, strategy)
+    problem = fe.checkIntegrity(root, rehash=rehash, hasher=hasher)
+    # missing files and size mismatches are found before any hashing
+    hashed = rehash and fe.hashd[0] != '-' and problem in ['ok', 'hash']
+    return (problem, os.path.join(fe.path, fe.name), hashed)
+
+def hashFileBlocks(job):
+    """Hash a file and its blocks for the signature sidecar
+
+    job is (fileName, blockSize, algorithm) so it can be used with Pool.imap
+    """
+    return blockHashes(job[0], job[1], job[2])
 
 ###############################################################################
 ###############################################################################
@@ -62,34 +128,374 @@ from screamingbackpack.fileEntity import FileEntity as FE
 
 class ManifestManager(object):
     """Use this interface for storing and managing file and paths"""
-    def __init__(self, manType=None, timeout=30):
+    def __init__(self, manType=None, timeout=30, jobs=1, useThreads=False, connections=4, progress=None):
         self.timeout = timeout
-         
+        self.jobs = max(1, jobs)            # number of workers used when hashing
+        self.useThreads = useThreads        # hash using threads instead of processes
+        self.connections = max(1, connections)  # number of simultaneous downloads
+
         self.files = []
+        self.root = None                    # absolute path of the tree being created
+        self.toHash = []                    # [FileEntity] waiting for a hash
+        self.keepStats = False              # fill self.stats during the walk (incremental builds)
+        self.stats = {}                     # {path => (size, mtime_ns, inode)} seen by walk
+        self.known = {}                     # {path => (hash, stat)} reusable by incremental builds
+        self.blockSize = 0                  # block size for signatures (0 == don't make any)
+        self.blocks = {}                    # {path => [block digests]}
+        self.hashAlgorithm = __DEFAULT_HASH__   # hash used by the last manifest created
+        self.readStrategy = __DEFAULT_READ__    # how files are read while hashing
+        self.sourceOptions = {}             # options from the header of the last source manifest
+        self.localOptions = {}              # options from the header of the last local manifest
+        self.sourceCache = None             # (path, meta) of the local copy of a remote source manifest
+        self.sidecarSpool = {}              # {name => temporary copy of a source sidecar, or None}
+        self.reused = []                    # paths satisfied from local data by the last update
+        self.duplicates = []                # jobs whose content is also being downloaded for another path
+        self.metrics = Metrics()            # time spent in each phase and counts of files and bytes
+        self.progress = progress            # callback(phase, files, total files, bytes, total bytes)
         if manType is not None:
             self.type = manType
         else:
             self.type = "generic"
 
-    def createManifest(self, path, manifestName=None):
-        """inventory all files in path and create a manifest file"""
+    def createManifest(self,
+                       path,
+                       manifestName=None,
+                       incremental=False,
+                       touched=None,
+                       blockSize=0,
+                       sortEntries=True,
+                       binaryIndex=False,
+                       merkle=False,
+                       hashAlgorithm=__DEFAULT_HASH__,
+                       readStrategy=__DEFAULT_READ__,
+                       bundleSize=0,
+                       bundleFileSize=65536):
+        """inventory all files in path and create a manifest file
+
+        if incremental is true then hashes are reused from the previous
+        manifest for any file whose size, mtime and inode match the sidecar
+        stat cache. Paths in touched are always re-hashed.
+
+        if blockSize is set then a sidecar of per-block signatures is written
+        for every file larger than one block. Clients use it to download only
+        the changed parts of modified files.
+
+        if sortEntries is true (the default) then entries are written in
+        path order which lets diffManifests stream the comparison. walk
+        already finds them in that order, so this only costs a sort when
+        entities have been added since (as watch does)
+
+        if binaryIndex is true then an indexed binary copy of the manifest
+        is also written (see openIndex)
+
+        if merkle is true then folder lines carry a hash of everything below
+        them (prefixed with "-") and their total size, so diffs can skip
+        unchanged subtrees. Older versions can't read these manifests.
+
+        hashAlgorithm is anything hashlib supports, or blake2b / blake2s.
+        readStrategy is one of buffered, readinto or mmap (see hashing.py).
+        Both are recorded in the header when they aren't the defaults.
+
+        if bundleSize is set then every file no bigger than bundleFileSize
+        is also packed into tar bundles of about bundleSize bytes (in
+        <manifestName>.packs) listed in <manifestName>.bundles. Clients
+        fetch runs of small files from these with one request.
+        """
         if manifestName is None:
             manifestName = __MANIFEST__
+        sig_name = manifestName + __SIGNATURES__
+        self.files = []
+        self.stats = {}
+        # only incremental builds (and watch) write the stat cache
+        self.keepStats = incremental
+        self.known = {}
+        self.blockSize = blockSize
+        self.blocks = {}
+        # fail now rather than in a worker
+        newHasher(hashAlgorithm)
+        if readStrategy not in __READ_STRATEGIES__:
+            raise ValueError("unknown read strategy %s" % readStrategy)
+        self.hashAlgorithm = hashAlgorithm
+        self.readStrategy = readStrategy
+        if incremental:
+            self.known = self.loadStatCache(path, manifestName)
+            if touched is not None:
+                for t in touched:
+                    self.known.pop(t, None)
+            if blockSize > 0:
+                try:
+                    with open(os.path.join(path, sig_name)) as sig_fh:
+                        (old_size, self.blocks, old_algorithm) = readSignatures(sig_fh)
+                    if old_size != blockSize or old_algorithm != hashAlgorithm:
+                        # signatures can't be reused so nor can the hashes
+                        self.blocks = {}
+                        self.known = {}
+                except IOError:
+                    self.known = {}
         # make the root file entity
         root_path = os.path.abspath(path)
+        self.root = root_path
         root_fe = FE('root', ".", None, "-", 0)
         self.files.append(root_fe)
         # now make all the ones below
-        parents = [root_fe]
-        dirs, files = self.listdir(path)[:2]
-        self.walk(parents, root_path, '', dirs, files, skipFile=manifestName)
+        with self.metrics.phase('walk'):
+            self.walk(root_fe, root_path, skipFiles=self.sidecarNames(manifestName))
+        files_seen = sum(1 for f in self.files if f.digest != '-')
+        self.metrics.count('files_seen', files_seen)
+        self.metrics.count('files_unchanged', files_seen - len(self.toHash))
+        # the stat cache is only matched against during the walk
+        self.known = {}
+        with self.metrics.phase('hash'):
+            self.hashPending()
+            dir_hashes = {}
+            if merkle:
+                dir_hashes = self.merkleHashes()
 
-        with open(os.path.join(path, manifestName), 'w') as man_fh:
+        with self.metrics.phase('write'):
+            self.writeOutputs(path,
+                              manifestName,
+                              merkle=merkle,
+                              dirHashes=dir_hashes,
+                              sortEntries=sortEntries,
+                              binaryIndex=binaryIndex,
+                              statCache=incremental,
+                              bundleSize=bundleSize,
+                              bundleFileSize=bundleFileSize)
+
+    def writeOutputs(self,
+                     path,
+                     manifestName,
+                     merkle=False,
+                     dirHashes=None,
+                     sortEntries=False,
+                     binaryIndex=False,
+                     statCache=False,
+                     bundleSize=0,
+                     bundleFileSize=65536,
+                     changed=None):
+        """Write the manifest and any sidecars for the entities in self.files
+
+        The manifest and each sidecar are written to a temporary file and
+        renamed into place so that nobody ever reads half of one. dirHashes
+        are the merkle folder hashes (see merkleHashes), signatures are
+        written if self.blockSize is set. changed is the set of paths touched
+        since the last write, if known, so only their bundles are repacked
+        """
+        if dirHashes is None:
+            dirHashes = {}
+        entries = [f for f in self.files if f.parent is not None]
+        if sortEntries and not self.isPathOrdered(entries):
+            entries = sorted(entries, key=lambda f: os.path.join(f.path, f.name))
+        tmp_path = os.path.join(path, manifestName + __TEMPORARY__)
+        with open(tmp_path, 'w') as man_fh:
             # print the header
-            man_fh.write("##%s##\tData manifest created by ScreamingBackpack version %s\n" % (self.type, __version__))
-            for f in self.files:
-                if f.parent is not None:
+            man_fh.write(self.makeHeader(merkle, self.hashAlgorithm, self.readStrategy))
+            for f in entries:
+                if f in dirHashes:
+                    man_fh.write("%s\t-%s\t%d\n" % ((os.path.join(f.path, f.name),) + dirHashes[f]))
+                else:
                     man_fh.write("%s\n" % f)
+        os.rename(tmp_path, os.path.join(path, manifestName))
+
+        if binaryIndex:
+            self.writeBinaryIndex(path,
+                                  manifestName,
+                                  [(os.path.join(f.path, f.name), f.hashd, f.size) for f in entries])
+
+        if statCache:
+            self.writeStatCache(path, manifestName)
+
+        if self.blockSize > 0:
+            signatures = []
+            for f in self.files:
+                if f.parent is not None and f.hashd != '-' and int(f.size) > self.blockSize:
+                    man_path = os.path.join(f.path, f.name)
+                    signatures.append((man_path, self.blocks[man_path]))
+            writeSignatures(os.path.join(path, manifestName + __SIGNATURES__), self.blockSize, signatures, self.hashAlgorithm)
+
+        if bundleSize > 0:
+            writeBundles(path,
+                         manifestName + __PACKS__,
+                         manifestName + __BUNDLES__,
+                         [(os.path.join(f.path, f.name), f.size) for f in entries if f.hashd != '-'],
+                         bundleSize,
+                         bundleFileSize,
+                         changed=changed)
+
+        # anything not rewritten above describes an older manifest
+        stale = []
+        if not binaryIndex:
+            stale.append(__BINARY__)
+        if self.blockSize == 0:
+            stale.append(__SIGNATURES__)
+        if bundleSize == 0:
+            stale += [__BUNDLES__, __PACKS__]
+        self.removeSidecars(path, manifestName, stale)
+
+    def writeBinaryIndex(self, path, manifestName, entries):
+        """Write the binary index for a manifest that is already in place
+
+        entries are (path, hex digest, size) as in the text manifest. The index records the stat key of the manifest
+        so openIndex can refuse one that has fallen behind
+        """
+        records = []
+        digest_size = 32
+        for (rel_path, hashd, size) in entries:
+            if hashd[0] == '-':
+                records.append((rel_path, '-', size))
+            elif len(hashd) > 1:
+                digest = binascii.unhexlify(hashd)
+                digest_size = len(digest)
+                records.append((rel_path, digest, size))
+            else:
+                records.append((rel_path, hashd, size))
+        man_key = self.statKey(os.stat(os.path.join(path, manifestName)))
+        writeBinaryManifest(os.path.join(path, manifestName + __BINARY__),
+                            self.type,
+                            records,
+                            digestSize=digest_size,
+                            manifestKey=man_key)
+
+    def removeSidecars(self, path, manifestName, suffixes):
+        """Remove the sidecars with the given suffixes, if there are any"""
+        for suffix in suffixes:
+            side_path = os.path.join(path, manifestName + suffix)
+            if os.path.isdir(side_path):
+                shutil.rmtree(side_path)
+            elif os.path.exists(side_path):
+                os.remove(side_path)
+
+    def isPathOrdered(self, entities):
+        """True if entities are already in path order (as walk leaves them)"""
+        last = None
+        for f in entities:
+            man_path = os.path.join(f.path, f.name)
+            if last is not None and man_path <= last:
+                return False
+            last = man_path
+        return True
+
+    def sidecarNames(self, manifestName):
+        """Names of the manifest and all the files kept next to it, which are never listed
+
+        Each of them is written under a temporary name first, so those are included too
+        """
+        cache_name = manifestName + __SOURCECACHE__
+        names = (manifestName,
+                 manifestName + __STATCACHE__,
+                 manifestName + __SIGNATURES__,
+                 manifestName + __BINARY__,
+                 cache_name,
+                 cache_name + ".meta",
+                 manifestName + __BUNDLES__,
+                 manifestName + __PACKS__)
+        return names + tuple([name + __TEMPORARY__ for name in names])
+
+    def merkleHashes(self):
+        """Hash every folder from the names, hashes and sizes of its children
+
+        Children are hashed in name order so the result doesn't depend on
+        the order the file system lists them in.
+        returns {folder entity => (hash, total size)}
+        """
+        children = {}
+        for f in self.files:
+            if f.parent is not None:
+                children.setdefault(f.parent, []).append(f)
+        dir_hashes = {}
+        # walk puts every folder before its contents
+        for f in reversed(self.files):
+            if f.hashd == '-':
+                hasher = newHasher(self.hashAlgorithm)
+                total = 0
+                for child in sorted(children.get(f, []), key=lambda c: c.name):
+                    if child.hashd == '-':
+                        (hashd, size) = dir_hashes[child]
+                        hashd = '-' + hashd
+                    else:
+                        (hashd, size) = (child.hashd, child.size)
+                    hasher.update("%s\t%s\t%d\n" % (child.name, hashd, size))
+                    total += size
+                dir_hashes[f] = (hasher.hexdigest(), total)
+        return dir_hashes
+
+    def verifyManifest(self, path, manifestName=None, mode='quick', fraction=0.1, readStrategy=None):
+        """Check the files under path against their manifest
+
+        mode is one of:
+            quick  - existence and size only (one stat per entry)
+            full   - also re-hash every file (using the hashing workers)
+            sample - re-hash a random fraction of files, quick check the rest
+        returns (number checked, number re-hashed, [(problem, path)]) where
+        problem is 'missing', 'size' or 'hash'
+
+        Files are hashed with the algorithm named in the manifest header and
+        read the way the header asks unless readStrategy is given
+        """
+        if manifestName is None:
+            manifestName = __MANIFEST__
+        root = os.path.abspath(path)
+
+        def makeJobs(man_fh):
+            algorithm = __DEFAULT_HASH__
+            strategy = readStrategy
+            for line in man_fh:
+                if line[0] == "#":
+                    options = self.getManOptions(line)
+                    algorithm = options.get('hash', __DEFAULT_HASH__)
+                    if strategy is None:
+                        strategy = options.get('read', __DEFAULT_READ__)
+                else:
+                    if mode == 'full':
+                        rehash = True
+                    elif mode == 'sample':
+                        rehash = random.random() < fraction
+                    else:
+                        rehash = False
+                    counts[0] += 1
+                    yield (root, line, rehash, algorithm, strategy)
+
+        counts = [0, 0]
+        problems = []
+        pool = None
+        if self.jobs > 1 and mode != 'quick':
+            if self.useThreads:
+                pool = ThreadPool(self.jobs)
+            else:
+                pool = Pool(self.jobs)
+        try:
+            with self.metrics.phase('verify'):
+                with open(os.path.join(path, manifestName)) as man_fh:
+                    if pool is None:
+                        results = (verifyEntry(job) for job in makeJobs(man_fh))
+                    else:
+                        results = pool.imap(verifyEntry, makeJobs(man_fh), chunksize=16)
+                    for (i, (problem, file_path, hashed)) in enumerate(results):
+                        if hashed:
+                            counts[1] += 1
+                        if problem != 'ok':
+                            problems.append((problem, file_path))
+                        if self.progress is not None:
+                            self.progress('verify', i + 1)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.metrics.count('entries_checked', counts[0])
+        self.metrics.count('files_rehashed', counts[1])
+        self.metrics.count('problems', len(problems))
+        return (counts[0], counts[1], problems)
+
+    def openIndex(self, location, manifestName=None):
+        """Open the binary copy of a manifest for point lookups and prefix scans
+
+        returns a BinaryManifest; use lookup(path) and prefixScan(folder).
+        Raises BinaryManifestError if the index is older than the manifest
+        """
+        if manifestName is None:
+            manifestName = __MANIFEST__
+        man_key = self.statKey(os.stat(os.path.join(location, manifestName)))
+        return BinaryManifest(os.path.join(location, manifestName + __BINARY__), manifestKey=man_key)
 
     def diffManifests(self,
                       localManifestLocation,
@@ -101,28 +507,36 @@ class ManifestManager(object):
 
         if remote is true then sourceManifestLocation is a URL
         returns a list of files that need to be updated
+
+        Path sorted manifests are compared as a streaming merge-join (see
+        iterDiffs). Subtrees whose merkle folder hashes match are skipped.
+        For older manifests, which aren't in path order, the source is
+        loaded into a lookup table (see iterUnsortedDiffs).
         """
         if localManifestName is None:
             localManifestName = __MANIFEST__
         if sourceManifestName is None:
             sourceManifestName = __MANIFEST__
 
-        # get the "type" of the local manifest
-        l_type = "generic"
+        # the type of the local manifest is checked against the source's
         with open(os.path.join(localManifestLocation, localManifestName)) as l_man:
-            for line in l_man:
-                if line[0] == "#":
-                    l_type = self.getManType(line)
-                break
+            l_header = l_man.readline()
 
         # load the source manifest
-        s_type = "generic"
-        source_man = {}
         source = ""
+        self.sourceCache = None
         # first we assume it is remote
         try:
-            s_man = urllib2.urlopen(sourceManifestLocation + "/" + sourceManifestName, None, self.timeout)
+            with self.metrics.phase('fetch'):
+                (s_man, unchanged) = self.fetchSourceManifest(sourceManifestLocation + "/" + sourceManifestName,
+                                                              os.path.join(localManifestLocation, localManifestName))
             source = sourceManifestLocation + "/"
+            if unchanged and self.isKnownClean(localManifestLocation, localManifestName):
+                # neither manifest has changed since they last matched
+                s_man.close()
+                if not printDiffs:
+                    return (source, [], [], [], [])
+                return
         except ValueError:
             # then it is probably a file
             s_man = open(os.path.join(sourceManifestLocation, sourceManifestName))
@@ -132,80 +546,60 @@ class ManifestManager(object):
             print "Error: failed to connect to server."
             return (None, None, None, None, None)
 
-        first_line = True
-        for line in s_man:
-            if first_line:
-                first_line = False
-                if line[0] == "#":
-                    # get the type of the manifest
-                    s_type = self.getManType(line)
-                    if s_type != l_type:
-                        print "Error: type of source manifest (%s) does not match type of local manifest (%s)" % (s_type, l_type)
-                        return (None, None, None, None, None)
-                else:
-                    # no type specified
-                    print "Error: type of source manifest is not specified. Is this a valid manifest file?"
-                    return (None, None, None, None, None)
-
-                self.type = l_type
-            if line[0] != "#":
-                fields = line.rstrip().split("\t")
-                # set the dict up as {path => [hash, size, seenLocal]
-                source_man[fields[0]] = [fields[1], fields[2], False]
+        if not self.compareHeaders(l_header, s_man.readline()):
+            s_man.close()
+            return (None, None, None, None, None)
 
-        # keep lists of modifications
-        deleted = []
-        addedDirs = []
-        addedFiles = []
-        modified = []
+        try:
+            # sorted manifests are parsed as they are diffed so this
+            # phase includes the parsing
+            with self.metrics.phase('diff'):
+                with open(os.path.join(localManifestLocation, localManifestName)) as l_man:
+                    changes = self.iterDiffs(self.iterManifest(l_man), self.iterManifest(s_man))
+                    (addedFiles, addedDirs, deleted, modified) = self.collectDiffs(changes)
+        except ManifestOrderError:
+            # older manifests are in walk order
+            s_man.seek(0)
+            with self.metrics.phase('diff'):
+                with open(os.path.join(localManifestLocation, localManifestName)) as l_man:
+                    changes = self.iterUnsortedDiffs(self.iterManifest(l_man, checkOrder=False),
+                                                     self.iterManifest(s_man, checkOrder=False))
+                    (addedFiles, addedDirs, deleted, modified) = self.collectDiffs(changes)
+        finally:
+            s_man.close()
+        self.metrics.count('files_added', len(addedFiles))
+        self.metrics.count('folders_added', len(addedDirs))
+        self.metrics.count('entries_deleted', len(deleted))
+        self.metrics.count('files_modified', len(modified))
 
-        with open(os.path.join(localManifestLocation, localManifestName)) as l_man:
-            for line in l_man:
-                if line[0] != "#":
-                    fields = line.rstrip().split("\t")
-                    try:
-                        if source_man[fields[0]][0] != fields[1]:
-                            # hashes don't match
-                            modified.append(fields[0])
-                        # seen this file
-                        source_man[fields[0]][2] = True
-                    except KeyError:
-                        # this file has been deleted from the source manifest
-                        deleted.append(fields[0])
-
-        # check for new files
-        for f in source_man.keys():
-            if source_man[f][2] == False:
-                if source_man[f][0] == '-':
-                    addedDirs.append(f)
-                else:
-                    addedFiles.append(f)
+        if len(addedFiles) + len(addedDirs) + len(deleted) + len(modified) == 0:
+            self.markClean(localManifestLocation, localManifestName)
 
         if printDiffs:
             new_size = 0
             modified_size = 0
             for f in addedFiles:
-                new_size += int(source_man[f][1])
+                new_size += int(f[1][1])
             for f in modified:
-                modified_size += int(source_man[f][1])
+                modified_size += int(f[1][1])
 
             if len(addedFiles) > 0:
                 print "#------------------------------------------------------"
                 print "# Source contains %d new file(s) (%s)" % (len(addedFiles), self.formatData(new_size))
                 for f in addedFiles:
-                    print "\t".join([self.formatData(int(source_man[f][1])), f])
+                    print "\t".join([self.formatData(int(f[1][1])), f[0]])
 
             if len(addedDirs) > 0:
                 print "#------------------------------------------------------"
                 print "# Source contains %d new folders(s)" % (len(addedDirs))
                 for f in addedDirs:
-                    print f
+                    print f[0]
 
             if len(modified) > 0:
                 print "#------------------------------------------------------"
                 print "# Source contains %d modified file(s) (%s)" % (len(modified), self.formatData(modified_size))
                 for f in modified:
-                    print f
+                    print f[0]
 
             if len(deleted) > 0:
                 print "#------------------------------------------------------"
@@ -214,19 +608,346 @@ class ManifestManager(object):
                     print f
         else:
             return (source,
-                    [(a, source_man[a]) for a in addedFiles],
-                    [(a, source_man[a]) for a in addedDirs],
+                    addedFiles,
+                    addedDirs,
                     deleted,
-                    [(m, source_man[m]) for m in modified])
+                    modified)
+
+    def compareHeaders(self, localHeader, sourceHeader):
+        """Check that two manifests can be compared, given their first lines
+
+        The options of both are kept and the type of the local manifest
+        becomes ours. Prints why and returns False if they can't be compared
+        """
+        l_type = "generic"
+        self.localOptions = {}
+        if len(localHeader) > 0 and localHeader[0] == "#":
+            l_type = self.getManType(localHeader)
+            self.localOptions = self.getManOptions(localHeader)
+        if len(sourceHeader) == 0 or sourceHeader[0] != "#":
+            # no type specified
+            print "Error: type of source manifest is not specified. Is this a valid manifest file?"
+            return False
+        s_type = self.getManType(sourceHeader)
+        self.sourceOptions = self.getManOptions(sourceHeader)
+        if s_type != l_type:
+            print "Error: type of source manifest (%s) does not match type of local manifest (%s)" % (s_type, l_type)
+            return False
+        s_hash = self.sourceOptions.get('hash', __DEFAULT_HASH__)
+        l_hash = self.localOptions.get('hash', __DEFAULT_HASH__)
+        if s_hash != l_hash:
+            # the hashes can't be compared so every file would look modified
+            print "Error: source manifest is hashed with %s but local manifest is hashed with %s" % (s_hash, l_hash)
+            print "Error: re-create the local manifest with: --hash %s" % s_hash
+            return False
+        self.type = l_type
+        return True
+
+    def fetchSourceManifest(self, url, localManifest):
+        """Fetch a remote manifest, keeping a local copy next to localManifest
+
+        The copy is kept with its ETag and Last-Modified so later fetches
+        are conditional. A gzipped manifest (url + ".gz") is preferred and
+        Content-Encoding: gzip is understood.
+        returns (open manifest, True if the copy was already up to date)
+        """
+        (response, cache_path, meta) = self.openSourceManifest(url, localManifest)
+        if response is None:
+            return (open(cache_path), True)
+        for chunk in self.streamSourceManifest(response, cache_path, meta):
+            pass
+        return (open(cache_path), False)
+
+    def openSourceManifest(self, url, localManifest):
+        """Make the (conditional) request for a remote manifest
+
+        returns (response, path of the local copy, meta). response is None
+        if the local copy is already up to date
+        """
+        cache_path = localManifest + __SOURCECACHE__
+        meta = {}
+        if os.path.exists(cache_path):
+            meta = self.readCacheMeta(cache_path + ".meta")
+        candidates = [url + ".gz", url]
+        if meta.get('url') in candidates:
+            # try whatever worked last time first
+            candidates.remove(meta['url'])
+            candidates.insert(0, meta['url'])
+        for candidate in candidates:
+            request = urllib2.Request(candidate, headers={'Accept-Encoding': 'gzip'})
+            if meta.get('url') == candidate:
+                if 'etag' in meta:
+                    request.add_header('If-None-Match', meta['etag'])
+                if 'last-modified' in meta:
+                    request.add_header('If-Modified-Since', meta['last-modified'])
+            try:
+                response = urllib2.urlopen(request, None, self.timeout)
+            except urllib2.HTTPError as e:
+                if e.code == 304:
+                    self.sourceCache = (cache_path, meta)
+                    return (None, cache_path, meta)
+                if candidate != candidates[-1]:
+                    # servers refuse unknown files in all sorts of ways
+                    # (403, 404, 410, ...), try the next name
+                    continue
+                raise
+            break
+
+        # what the mirrors served (see findMirrors) doesn't depend on this
+        mirror_meta = dict([(k, v) for (k, v) in meta.items() if k.startswith("mirror ")])
+        meta = {'url': candidate}
+        meta.update(mirror_meta)
+        for header in ['etag', 'last-modified']:
+            if response.info().get(header) is not None:
+                meta[header] = response.info().get(header)
+        return (response, cache_path, meta)
+
+    def streamSourceManifest(self, response, cachePath, meta):
+        """Yield the (decompressed) manifest in chunks as it arrives
+
+        The local copy and its meta are only saved once the whole manifest
+        has been read
+        """
+        gzipped = meta['url'].endswith(".gz") or response.info().get('Content-Encoding') == 'gzip'
+        tmp_path = cachePath + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as cache_fh:
+                decompressor = None
+                if gzipped:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                buf = response.read(65536)
+                while len(buf) > 0:
+                    if decompressor is not None:
+                        buf = decompressor.decompress(buf)
+                    cache_fh.write(buf)
+                    yield buf
+                    buf = response.read(65536)
+                if decompressor is not None:
+                    buf = decompressor.flush()
+                    cache_fh.write(buf)
+                    yield buf
+            os.rename(tmp_path, cachePath)
+            self.writeCacheMeta(cachePath + ".meta", meta)
+        finally:
+            response.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.sourceCache = (cachePath, meta)
+
+    def readCacheMeta(self, metaPath):
+        """Load the key / value pairs stored alongside the cached source manifest"""
+        meta = {}
+        try:
+            with open(metaPath) as meta_fh:
+                for line in meta_fh:
+                    fields = line.rstrip("\n").split("\t", 1)
+                    if len(fields) == 2:
+                        meta[fields[0]] = fields[1]
+        except IOError:
+            pass
+        return meta
+
+    def writeCacheMeta(self, metaPath, meta):
+        with open(metaPath, 'w') as meta_fh:
+            for key in sorted(meta.keys()):
+                meta_fh.write("%s\t%s\n" % (key, meta[key]))
+
+    def isKnownClean(self, localManifestLocation, localManifestName):
+        """True if the local manifest hasn't changed since it last matched the cached source"""
+        stamp = self.statKey(os.stat(os.path.join(localManifestLocation, localManifestName)))
+        return self.sourceCache is not None and self.sourceCache[1].get('clean') == "%d:%d:%d" % stamp
+
+    def markClean(self, localManifestLocation, localManifestName):
+        """Remember that the local manifest matches the cached source manifest"""
+        if self.sourceCache is None:
+            return
+        (cache_path, meta) = self.sourceCache
+        stamp = self.statKey(os.stat(os.path.join(localManifestLocation, localManifestName)))
+        meta['clean'] = "%d:%d:%d" % stamp
+        self.writeCacheMeta(cache_path + ".meta", meta)
+
+    def collectDiffs(self, changes):
+        """Gather the records from iterDiffs into the lists diffManifests returns"""
+        added_files = []
+        added_dirs = []
+        deleted = []
+        modified = []
+        for (change, path, hashd, size) in changes:
+            if change == 'added':
+                added_files.append((path, [hashd, size, False]))
+            elif change == 'addedDir':
+                added_dirs.append((path, [hashd, size, False]))
+            elif change == 'modified':
+                modified.append((path, [hashd, size, True]))
+            else:
+                deleted.append(path)
+        return (added_files, added_dirs, deleted, modified)
+
+    def iterDiffs(self, localEntries, sourceEntries):
+        """Merge-join two path sorted streams of (path, hash, size)
+
+        yields (change, path, hash, size) where change is one of 'added',
+        'addedDir', 'modified' or 'deleted'. hash and size come from the
+        source except for deletions. Only one entry from each side is held
+        in memory at a time.
+
+        Subtrees whose merkle folder hashes match are skipped, but both
+        streams are still read to the end: the source manifest has to be
+        fetched and parsed in full however little has changed
+        """
+        pruned = []
+        local_iter = self.pruneSubtrees(localEntries, pruned)
+        source_iter = self.pruneSubtrees(sourceEntries, pruned)
+        l = next(local_iter, None)
+        s = next(source_iter, None)
+        while l is not None or s is not None:
+            if s is None or (l is not None and l[0] < s[0]):
+                # this file has been deleted from the source manifest
+                yield ('deleted',) + l
+                l = next(local_iter, None)
+            elif l is None or s[0] < l[0]:
+                if s[1][0] == '-':
+                    yield ('addedDir',) + s
+                else:
+                    yield ('added',) + s
+                s = next(source_iter, None)
+            else:
+                if l[1][0] == '-' and s[1][0] == '-':
+                    if len(l[1]) > 1 and l[1] == s[1]:
+                        # identical merkle hashes, nothing below has changed
+                        pruned.append(l[0] + "/")
+                elif l[1] != s[1]:
+                    # hashes don't match
+                    yield ('modified',) + s
+                l = next(local_iter, None)
+                s = next(source_iter, None)
+
+    def iterUnsortedDiffs(self, localEntries, sourceEntries):
+        """Compare manifests which aren't in path order
+
+        Only the source is held in memory, as a lookup table, while the
+        local entries stream past. Yields the same records as iterDiffs;
+        changes to local entries come in local order, then additions in
+        path order (so new folders come before their contents)
+        """
+        source = {}
+        for (path, hashd, size) in sourceEntries:
+            source[path] = (hashd, size)
+        for (path, hashd, size) in localEntries:
+            s = source.pop(path, None)
+            if s is None:
+                # this file has been deleted from the source manifest
+                yield ('deleted', path, hashd, size)
+            elif hashd != s[0] and not (hashd[0] == '-' and s[0][0] == '-'):
+                # hashes don't match
+                yield ('modified', path) + s
+        for path in sorted(source.keys()):
+            (hashd, size) = source[path]
+            if hashd[0] == '-':
+                yield ('addedDir', path, hashd, size)
+            else:
+                yield ('added', path, hashd, size)
+
+    def pruneSubtrees(self, entries, pruned):
+        """Drop path sorted entries which lie below any folder in pruned
 
+        Everything below a folder is contiguous in path order, so once an
+        entry sorts after a folder's block that folder can be forgotten.
+        Dropped entries have still been read (and parsed) from entries
+        """
+        stack = []
+        seen = 0
+        for entry in entries:
+            while seen < len(pruned):
+                stack.append(pruned[seen])
+                seen += 1
+            while len(stack) > 0 and entry[0] > stack[-1] and not entry[0].startswith(stack[-1]):
+                stack.pop()
+            if len(stack) > 0 and entry[0].startswith(stack[-1]):
+                continue
+            yield entry
+
+    def isSortedManifest(self, manifestPath):
+        """True if every entry of the manifest at manifestPath is in path order"""
+        try:
+            with open(manifestPath) as man_fh:
+                for entry in self.iterManifest(man_fh):
+                    pass
+        except ManifestOrderError:
+            return False
+        return True
+
+    def iterManifest(self, lines, checkOrder=True):
+        """Yield (path, hash, size) for every entry in a manifest
+
+        if checkOrder is true then ManifestOrderError is raised as soon as
+        an entry is out of path order
+        """
+        last = None
+        for line in lines:
+            if line[0] != "#":
+                fields = line.rstrip().split("\t")
+                if checkOrder:
+                    if last is not None and fields[0] <= last:
+                        raise ManifestOrderError("%s follows %s" % (fields[0], last))
+                    last = fields[0]
+                yield (fields[0], fields[1], fields[2])
 
     def updateManifest(self,
                        localManifestLocation,
                        sourceManifestLocation,
                        localManifestName=None,
                        sourceManifestName=None,
-                       prompt=True):
-        """Update local files based on remote changes"""
+                       prompt=True,
+                       incremental=False,
+                       reuse='reflink',
+                       store=None,
+                       approveDownload=None,
+                       approveDelete=None,
+                       pipeline=True,
+                       mirrors=None,
+                       segmentSize=__SEGMENT_SIZE__):
+        """Update local files based on remote changes
+
+        if incremental is true then only downloaded files (and files whose
+        stats have changed) are re-hashed when the manifest is rebuilt
+
+        new and modified files whose content is already on disk (anywhere in
+        the local manifest or in the shared content store) are put in place
+        with a hardlink, reflink or copy (set by reuse, None to disable)
+        instead of being downloaded. Deletions wait until this is done.
+
+        approveDownload and approveDelete answer the questions up front
+        (None means ask, unless prompt is false). When both are answered
+        the update runs as a pipeline (see pipeline.py) which starts
+        downloading while the diff is still running, unless pipeline is false
+
+        mirrors are other URLs serving the same source. Those whose manifest
+        matches the source's share the downloads, and files larger than
+        segmentSize are split into ranges fetched from several at once
+        """
+        if localManifestName is None:
+            localManifestName = __MANIFEST__
+        self.closeSidecars()
+        if not prompt:
+            if approveDownload is None:
+                approveDownload = False
+            if approveDelete is None:
+                approveDelete = False
+        if pipeline and approveDownload is not None and approveDelete is not None:
+            # imported here as the pipeline is built on this module
+            from screamingbackpack.pipeline import UpdatePipeline
+            return UpdatePipeline(self,
+                                  localManifestLocation,
+                                  sourceManifestLocation,
+                                  localManifestName=localManifestName,
+                                  sourceManifestName=sourceManifestName,
+                                  download=approveDownload,
+                                  delete=approveDelete,
+                                  reuse=reuse,
+                                  store=store,
+                                  mirrors=mirrors,
+                                  segmentSize=segmentSize).run()
         # get the diffs
         source, added_files, added_dirs, deleted, modified = self.diffManifests(localManifestLocation,
                                                                                 sourceManifestLocation,
@@ -235,17 +956,23 @@ class ManifestManager(object):
         # bail if the diff failed
         if source is None:
             return False
+        # diffManifests has checked that both sides use the same hash
+        algorithm = self.sourceOptions.get('hash', __DEFAULT_HASH__)
 
         # no changes by default
         do_down = False
         do_del = False
-        if prompt:
+        if approveDownload is not None:
+            do_down = approveDownload and len(added_files) + len(added_dirs) + len(modified) > 0
+        if approveDelete is not None:
+            do_del = approveDelete and len(deleted) > 0
+        if approveDownload is None or approveDelete is None:
             total_size = 0
             for f in added_files:
                 total_size += int(f[1][1])
             for f in modified:
                 total_size += int(f[1][1])
-            if total_size != 0:
+            if total_size != 0 and approveDownload is None:
                 print "****************************************************************"
                 print "%d new file(s) to be downloaded from source" % len(added_files)
                 print "%d existing file(s) to be updated" % len(modified)
@@ -254,7 +981,7 @@ class ManifestManager(object):
                 if not do_down:
                     print "Download aborted"
 
-            if len(deleted) > 0:
+            if len(deleted) > 0 and approveDelete is None:
                 print "****************************************************************"
                 print "The following %d file(s) are scheduled to be removed" % len(deleted)
                 for delete in deleted:
@@ -264,7 +991,30 @@ class ManifestManager(object):
                     print "Deletion aborted"
 
         update_manifest = False
-        # first delete
+        touched = []
+        errors = []
+        jobs = []
+        if do_down:
+            update_manifest = True
+            for add in added_dirs:
+                # make the dirs first
+                full_path = os.path.abspath(os.path.join(localManifestLocation, add[0]))
+                self.makeSurePathExists(full_path)
+            for add in added_files + modified:
+                full_path = os.path.abspath(os.path.join(localManifestLocation, add[0]))
+                jobs.append((add[0], full_path, add[1][0]))
+
+            # use local copies of the content before anything is deleted
+            reuser = None
+            if reuse is not None or store is not None:
+                reuser = LocalReuser(localManifestLocation, mode=reuse, store=store, hashAlgorithm=algorithm)
+                with self.metrics.phase('reuse'):
+                    jobs = self.reuseLocal(reuser, localManifestLocation, localManifestName, jobs)
+                touched = [p for p in self.reused]
+                self.metrics.count('files_reused', len(self.reused))
+                self.metrics.count('bytes_reused', reuser.bytesReused)
+
+        # then delete
         if do_del:
             update_manifest = True
             deleted_dirs = []
@@ -275,45 +1025,294 @@ class ManifestManager(object):
                     deleted_files.append(full_path)
                 else:
                     deleted_dirs.append(full_path)
-            for delete in deleted_dirs:
-                shutil.rmtree(delete, ignore_errors=True)
-            for delete in deleted_files:
-                print delete
-                os.remove(delete)
+            with self.metrics.phase('delete'):
+                for delete in deleted_dirs:
+                    shutil.rmtree(delete, ignore_errors=True)
+                for delete in deleted_files:
+                    # may have gone with its folder
+                    if os.path.exists(delete):
+                        print delete
+                        os.remove(delete)
+            self.metrics.count('files_deleted', len(deleted_files))
+            self.metrics.count('folders_deleted', len(deleted_dirs))
 
         if do_down:
-            update_manifest = True
-            for add in added_dirs:
-                # make the dirs first
-                full_path = os.path.abspath(os.path.join(localManifestLocation, add[0]))
-                self.makeSurePathExists(full_path)
-            for add in added_files:
-                full_path = os.path.abspath(os.path.join(localManifestLocation, add[0]))
-                urllib.urlretrieve(source+add[0], full_path)
-            for modify in modified:
-                full_path = os.path.abspath(os.path.join(localManifestLocation, modify[0]))
-                urllib.urlretrieve(source+modify[0], full_path)
+            downloader = Downloader(source,
+                                    connections=self.connections,
+                                    timeout=self.timeout,
+                                    hashAlgorithm=algorithm,
+                                    progress=self.progress,
+                                    mirrors=self.findMirrors(source, mirrors, sourceManifestName),
+                                    segmentSize=segmentSize)
+            sizes = dict([(f[0], int(f[1][1])) for f in added_files + modified])
+            downloader.sizes = sizes
+            total_bytes = sum([sizes[j[0]] for j in jobs])
+            runs = []
+            with self.metrics.phase('download'):
+                if downloader.isHttp():
+                    (runs, jobs) = self.planBundles(source, sourceManifestName, jobs)
+                if len(modified) > 0 and downloader.isHttp():
+                    self.loadRemoteSignatures(downloader, source, sourceManifestName, dict([(m[0], int(m[1][1])) for m in modified]))
+                errors = downloader.fetchAll(jobs, totalBytes=total_bytes, runs=runs)
+            # files taken from bundles have been downloaded too
+            jobs = jobs + [j for r in runs for j in r.jobs()]
+            self.metrics.count('bundle_requests', len(runs))
+            self.metrics.count('files_segmented', downloader.filesSegmented)
+            self.metrics.count('files_downloaded', downloader.filesDone)
+            self.metrics.count('bytes_downloaded', downloader.bytesDone)
+            self.metrics.count('bytes_delta_reused', downloader.bytesReused)
+            self.metrics.count('download_errors', len(errors))
+            if downloader.bytesReused > 0:
+                print "Delta sync reused %s of existing data" % self.formatData(downloader.bytesReused)
+            failed = set([e[0] for e in errors])
+            for (path, full_path, hashd) in jobs:
+                if path not in failed:
+                    touched.append(path)
+                    if reuser is not None:
+                        reuser.addToStore(hashd, full_path)
+                        reuser.index.setdefault(hashd, []).append(path)
+            if reuser is not None:
+                for (path, full_path, hashd) in self.duplicates:
+                    if self.reuseOne(reuser, path, full_path, hashd):
+                        touched.append(path)
+                    else:
+                        errors.append((path, "duplicate content could not be copied"))
+            if len(errors) > 0:
+                print "****************************************************************"
+                print "Error: %d file(s) could not be downloaded" % len(errors)
+                for (path, msg) in errors:
+                    print "\t".join([path, msg])
 
         if update_manifest:
-            print "(re) creating manifest file (please be patient)"
-            self.createManifest(localManifestLocation, manifestName=localManifestName)
-            
-        return True
+            if incremental:
+                print "(re) creating manifest file"
+            else:
+                print "(re) creating manifest file (please be patient)"
+            with self.metrics.phase('rebuild'):
+                self.createManifest(localManifestLocation,
+                                    manifestName=localManifestName,
+                                    incremental=incremental,
+                                    touched=touched,
+                                    sortEntries=True,
+                                    merkle=(self.sourceOptions.get('dirs') == 'merkle'),
+                                    hashAlgorithm=algorithm,
+                                    readStrategy=self.localOptions.get('read', __DEFAULT_READ__),
+                                    binaryIndex=os.path.exists(os.path.join(localManifestLocation,
+                                                                            localManifestName + __BINARY__)))
+
+        return len(errors) == 0
+
+    def reuseLocal(self, reuser, localManifestLocation, localManifestName, jobs):
+        """Satisfy download jobs from content which is already on disk
+
+        returns the jobs which still need to be downloaded
+        """
+        self.indexLocal(reuser, os.path.join(localManifestLocation, localManifestName), set([j[2] for j in jobs]))
+        self.reused = []
+        self.duplicates = []
+        remaining = []
+        queued = set()
+        for (path, full_path, hashd) in jobs:
+            if self.reuseOne(reuser, path, full_path, hashd):
+                self.reused.append(path)
+            elif hashd in queued:
+                # same content as another download, copy it afterwards
+                self.duplicates.append((path, full_path, hashd))
+            else:
+                queued.add(hashd)
+                remaining.append((path, full_path, hashd))
+        if len(self.reused) > 0:
+            print "%d file(s) (%s) copied from existing local data" % (len(self.reused), self.formatData(reuser.bytesReused))
+        return remaining
+
+    def indexLocal(self, reuser, manifestPath, wanted):
+        """Index the local copies of the content in wanted (a set of hashes)
+
+        Hashes which are already indexed are not looked for again
+        """
+        wanted = set([h for h in wanted if h not in reuser.index])
+        if len(wanted) == 0:
+            return
+        with open(manifestPath) as l_man:
+            reuser.indexManifest(l_man, wanted)
+
+    def reuseOne(self, reuser, path, full_path, hashd):
+        # ends in the partial suffix so walk never picks it up
+        (head, tail) = os.path.split(full_path)
+        tmp_path = os.path.join(head, "." + tail + ".reuse" + __PARTIAL__)
+        return reuser.reuse(hashd, full_path, tmp_path)
+
+    def findMirrors(self, source, mirrors, sourceManifestName=None):
+        """Check which mirrors serve the same manifest as source and rank them all by speed
+
+        The source's manifest is checked against the local copy fetched for
+        the diff, and what each mirror served last time is kept with that
+        copy, so normally every location only answers a conditional request
+        returns [Mirror] fastest first, or None if there are no mirrors to use
+        """
+        if mirrors is None or len(mirrors) == 0:
+            return None
+        if sourceManifestName is None:
+            sourceManifestName = __MANIFEST__
+        if not source.startswith("http://") and not source.startswith("https://"):
+            print "Warning: mirrors are only used with an http(s) source, ignoring them"
+            return None
+        locations = [source] + [m.rstrip("/") + "/" for m in mirrors]
+        known = {}
+        if self.sourceCache is not None:
+            (cache_path, meta) = self.sourceCache
+            known = self.loadMirrorMeta(meta)
+            with open(cache_path, 'rb') as cache_fh:
+                known[source] = (entriesDigest(cache_fh), dict([(k, meta[k]) for k in ['url', 'etag', 'last-modified'] if k in meta]))
+        with self.metrics.phase('probe'):
+            (found, dropped, probed) = probeMirrors(locations, sourceManifestName, self.timeout, known)
+        if self.sourceCache is not None:
+            self.saveMirrorMeta(probed, locations[1:])
+        for (location, reason) in dropped:
+            print "Warning: not using mirror %s: %s" % (location, reason)
+        self.metrics.count('mirrors', len(found))
+        if len(found) > 1:
+            print "Downloading from %d mirror(s), fastest first:" % len(found)
+            for mirror in found:
+                print "\t%s\t%d ms" % (mirror.source, int(1000 / mirror.rate))
+        return found
+
+    def loadMirrorMeta(self, meta):
+        """What each mirror served when it was last probed, from the source cache meta
+
+        returns {location => (digest, validators)}
+        """
+        known = {}
+        for (key, value) in meta.items():
+            if key.startswith("mirror "):
+                fields = value.split("\t")
+                validators = dict([(k, v) for (k, v) in zip(['url', 'etag', 'last-modified'], fields[1:]) if v != ''])
+                known[key[7:]] = (fields[0], validators)
+        return known
+
+    def saveMirrorMeta(self, probed, locations):
+        """Keep what the mirrors served with the source cache for the next probe"""
+        (cache_path, meta) = self.sourceCache
+        for key in [k for k in meta.keys() if k.startswith("mirror ")]:
+            del meta[key]
+        for location in locations:
+            if location in probed:
+                (digest, validators) = probed[location]
+                fields = [digest] + [validators.get(k, '') for k in ['url', 'etag', 'last-modified']]
+                meta["mirror " + location] = "\t".join(fields)
+        self.writeCacheMeta(cache_path + ".meta", meta)
+
+    def sourceSidecar(self, source, sourceManifestName, suffix):
+        """Open a sidecar the source publishes next to its manifest
+
+        It is fetched once per update into a temporary file, so it can be
+        read again for every batch of changes without going back to the
+        source. Don't close it (see closeSidecars)
+        returns the file, rewound, or None if the source has no such sidecar
+        """
+        if sourceManifestName is None:
+            sourceManifestName = __MANIFEST__
+        name = sourceManifestName + suffix
+        if name not in self.sidecarSpool:
+            spool = None
+            try:
+                in_fh = urllib2.urlopen(source + name, None, self.timeout)
+                try:
+                    spool = tempfile.TemporaryFile()
+                    shutil.copyfileobj(in_fh, spool, __READ_SIZE__)
+                finally:
+                    in_fh.close()
+            except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError):
+                # fine, the files are simply fetched one by one and in full
+                if spool is not None:
+                    spool.close()
+                spool = None
+            self.sidecarSpool[name] = spool
+        spool = self.sidecarSpool[name]
+        if spool is not None:
+            spool.seek(0)
+        return spool
+
+    def closeSidecars(self):
+        for spool in self.sidecarSpool.values():
+            if spool is not None:
+                spool.close()
+        self.sidecarSpool = {}
+
+    def loadBundleIndex(self, source, sourceManifestName, wanted):
+        """Find where the paths in wanted are in the source's bundles
+
+        returns (packs folder, {path => (bundle, data offset, size)}), the
+        folder is None if the source has no (readable) bundle index
+        """
+        index_fh = self.sourceSidecar(source, sourceManifestName, __BUNDLES__)
+        if index_fh is None:
+            return (None, {})
+        try:
+            return readBundleIndex(index_fh, wanted=wanted)
+        except (IndexError, ValueError):
+            print "Warning: ignoring a damaged bundle index"
+            return (None, {})
+
+    def planBundles(self, source, sourceManifestName, jobs):
+        """Take runs of small files from the source's bundles where it can
+
+        Sources without bundles simply fetch every file on its own
+        returns ([BundleRun], remaining jobs)
+        """
+        (packs_name, entries) = self.loadBundleIndex(source, sourceManifestName, set([j[0] for j in jobs]))
+        if packs_name is None:
+            return ([], jobs)
+        (runs, remaining) = planRuns(packs_name, entries, jobs)
+        if len(runs) > 0:
+            print "%d small file(s) will be fetched with %d bundle request(s)" % (sum([len(r.members) for r in runs]), len(runs))
+        return (runs, remaining)
+
+    def loadRemoteSignatures(self, downloader, source, sourceManifestName, wanted):
+        """Hand the block signatures of the files in wanted ({path => size}) to the downloader
+
+        Sources without a signature sidecar are simply downloaded in full
+        """
+        sig_fh = self.sourceSidecar(source, sourceManifestName, __SIGNATURES__)
+        if sig_fh is None:
+            return
+        try:
+            (block_size, signatures, algorithm) = readSignatures(sig_fh, wanted=wanted)
+        except (IndexError, ValueError):
+            print "Warning: ignoring damaged block signatures"
+            return
+        downloader.signatureSize = block_size
+        downloader.signatureAlgorithm = algorithm
+        for (path, blocks) in signatures.items():
+            downloader.signatures[path] = (blocks, wanted[path])
+
+    def makeHeader(self, merkle=False, hashAlgorithm=__DEFAULT_HASH__, readStrategy=__DEFAULT_READ__):
+        """The first line of a manifest, options are only added if needed"""
+        header = "##%s##\tData manifest created by ScreamingBackpack version %s" % (self.type, __version__)
+        if merkle:
+            header += "\tdirs=merkle"
+        if hashAlgorithm != __DEFAULT_HASH__:
+            header += "\thash=%s" % hashAlgorithm
+        if readStrategy != __DEFAULT_READ__:
+            header += "\tread=%s" % readStrategy
+        return header + "\n"
 
     def getManType(self, line):
         """Work out the manifest type from the first line of the file"""
         return line.rstrip().split("##")[1]
 
+    def getManOptions(self, line):
+        """Get any key=value options from the end of the header line"""
+        options = {}
+        for field in line.rstrip().split("\t")[2:]:
+            if "=" in field:
+                (key, value) = field.split("=", 1)
+                options[key] = value
+        return options
+
     def formatData(self, amount):
-        """Pretty print file sizes"""
-        if amount < 1024*1024:
-            return "%d B" % amount
-        elif amount < 1024*1024*1024:
-            return "%0.2f MB" % (float(amount)/(1024.*1024.))
-        elif amount < 1024*1024*1024*1024:
-            return "%0.2f GB" % (float(amount)/(1024.*1024.*1024.))
-        elif amount < 1024*1024*1024*1024*1024:
-            return "%0.2f TB" % (float(amount)/(1024.*1024.*1024.*1024.))
+        """Pretty print file sizes (see instrumentation.formatData)"""
+        return formatData(amount)
 
 #-----------------------------------------------------------------------------
 # FS utilities
@@ -366,53 +1365,237 @@ class ManifestManager(object):
                 minimal = True
 
 
-    def walk(self, parents, full_path, rel_path, dirs, files, skipFile=__MANIFEST__):
-        """recursive walk through directory tree"""
-        # first do files here
-        for f in files:
-            if f != skipFile:
-                path = os.path.join(full_path, f)
-                self.files.append(FE(f,
-                                     rel_path,
-                                     parents[-1],
-                                     self.hashfile(path),
-                                     os.path.getsize(path)
-                                     )
-                                  )
-        for d in dirs:
-            # the walk will go into these dirs first
-            tmp_fe = FE(d, rel_path, parents[-1], "-", 0)
-            self.files.append(tmp_fe)
-            parents.append(tmp_fe)
-            new_full_path = os.path.join(full_path, d)
-            new_rel_path = os.path.join(rel_path, d)
-            new_dirs, new_files = self.listdir(new_full_path)[:2]
-            self.walk(parents, new_full_path, new_rel_path, new_dirs, new_files)
-            parents.pop()
+    def walk(self, root_fe, root_path, skipFiles=(__MANIFEST__,), relPath=''):
+        """walk through directory tree
 
-    def listdir(self, path):
-        """List dirs, files etc in path (one dir deep)"""
+        Uses an explicit stack rather than recursion so deep trees can't hit
+        the recursion limit. Entities come out in path order (a folder just
+        before its contents), so sorted manifests don't need sorting.
+        skipFiles (files or folders) only applies to the root folder.
+        relPath is the manifest path of root_fe when walking part of a tree
+        """
+        # ('scan', folder entity, full path, relative path, names to skip),
+        # ('folder', folder entity) or ('file', name, relative path of the
+        # parent, parent entity, stat)
+        stack = [('scan', root_fe, root_path, relPath, skipFiles)]
+        while len(stack) > 0:
+            item = stack.pop()
+            if item[0] == 'file':
+                self.addFile(*item[1:])
+                continue
+            if item[0] == 'folder':
+                self.files.append(item[1])
+                continue
+            (action, dir_fe, full_path, rel_path, skip) = item
+            dirs, files = self.scanDir(full_path)[:2]
+            children = []
+            names = set([f for (f, st) in files])
+            for (f, st) in files:
+                if f not in skip and not self.isPartial(f, rel_path, names):
+                    children.append((f, ('file', f, rel_path, dir_fe, st)))
+            for d in dirs:
+                if d not in skip:
+                    sub_fe = FE(d, rel_path, dir_fe, "-", 0)
+                    children.append((d, ('folder', sub_fe)))
+                    # a folder's contents sort as its name plus "/", which
+                    # can put siblings (like "a-b" for "a") in between
+                    children.append((d + "/", ('scan',
+                                               sub_fe,
+                                               os.path.join(full_path, d),
+                                               os.path.join(rel_path, d),
+                                               (__MANIFEST__,))))
+            children.sort(key=lambda c: c[0])
+            for (key, child) in reversed(children):
+                stack.append(child)
+
+    def isPartial(self, name, relPath, names):
+        """True if name is an unfinished download or copy of a file in the
+        same folder (names) or in the manifest being updated (self.known)
+
+        Anything else, even if it is called ".x.sbpart", is data
+        """
+        for target in partialTargets(name):
+            if target in names or os.path.join(relPath, target) in self.known:
+                return True
+        return False
+
+    def addFile(self, name, rel_path, parent, st):
+        """Make the entity for a file and queue it up for hashing if needed
+
+        Stats are only kept (in self.stats) when self.keepStats is set
+        """
+        tmp_fe = FE(name,
+                    rel_path,
+                    parent,
+                    "?",
+                    st.st_size
+                    )
+        self.files.append(tmp_fe)
+        if self.keepStats:
+            man_path = os.path.join(rel_path, name)
+            stat_key = self.statKey(st)
+            self.stats[man_path] = stat_key
+            try:
+                (old_hash, old_key) = self.known[man_path]
+                if old_key == stat_key:
+                    tmp_fe.hashd = old_hash
+                    return
+            except KeyError:
+                pass
+        self.toHash.append(tmp_fe)
+
+    def scanDir(self, path):
+        """List dirs, files and links in path (one dir deep)
+
+        files are (name, stat) pairs. With scandir the file type usually
+        comes free from the directory listing, so there is a single stat
+        per file (none for folders). Links are followed as in os.path.isdir
+        and os.path.isfile.
+        """
         dirs, files, links = [], [], []
+        if scandir is not None:
+            for entry in scandir(path):
+                try:
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append((entry.name, entry.stat()))
+                    elif entry.is_symlink():
+                        links.append(entry.name)
+                except OSError:
+                    # vanished, or a broken link
+                    links.append(entry.name)
+            return dirs, files, links
+
         for name in os.listdir(path):
             path_name = os.path.join(path, name)
-            if os.path.isdir(path_name):
-                dirs.append(name)
-            elif os.path.isfile(path_name):
-                files.append(name)
-            elif os.path.islink(path_name):
+            try:
+                st = os.lstat(path_name)
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(path_name)
+            except OSError:
                 links.append(name)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(name)
+            elif stat.S_ISREG(st.st_mode):
+                files.append((name, st))
         return dirs, files, links
 
-    def hashfile(self, fileName, blocksize=65536):
+    def listdir(self, path):
+        """List dirs, files etc in path (one dir deep)"""
+        dirs, files, links = self.scanDir(path)
+        return dirs, [f[0] for f in files], links
+
+    def statKey(self, st):
+        """Reduce a stat result to the fields used to detect changed files"""
+        try:
+            mtime_ns = st.st_mtime_ns
+        except AttributeError:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return (st.st_size, mtime_ns, st.st_ino)
+
+    def loadStatCache(self, path, manifestName):
+        """Load the sidecar stat cache and join it with the hashes in the manifest
+
+        returns {path => (hash, (size, mtime_ns, inode))}. Missing or
+        unreadable files simply mean nothing can be reused
+        """
+        hashes = {}
+        known = {}
+        try:
+            with open(os.path.join(path, manifestName)) as man_fh:
+                for line in man_fh:
+                    if line[0] == "#":
+                        if self.getManOptions(line).get('hash', __DEFAULT_HASH__) != self.hashAlgorithm:
+                            # the old hashes are no use to us
+                            return {}
+                    else:
+                        fields = line.rstrip().split("\t")
+                        if fields[1][0] != '-':
+                            hashes[fields[0]] = fields[1]
+            with open(os.path.join(path, manifestName + __STATCACHE__)) as stat_fh:
+                for line in stat_fh:
+                    if line[0] != "#":
+                        fields = line.rstrip().split("\t")
+                        try:
+                            known[fields[0]] = (hashes[fields[0]], tuple([int(x) for x in fields[1:4]]))
+                        except KeyError:
+                            pass
+        except IOError:
+            return {}
+        return known
+
+    def writeStatCache(self, path, manifestName):
+        """Write the stats of all files seen by the last walk"""
+        stat_path = os.path.join(path, manifestName + __STATCACHE__)
+        with open(stat_path + __TEMPORARY__, 'w') as stat_fh:
+            stat_fh.write("##stat##\tpath\tsize\tmtime_ns\tinode\n")
+            for f in self.files:
+                if f.parent is not None and f.hashd != '-':
+                    man_path = os.path.join(f.path, f.name)
+                    stat_fh.write("%s\t%d\t%d\t%d\n" % ((man_path,) + self.stats[man_path]))
+        os.rename(stat_path + __TEMPORARY__, stat_path)
+
+    def hashPending(self):
+        """Hash all files queued up by walk
+
+        Digests are assigned back to the entities they came from so the
+        manifest order is the same regardless of the number of workers.
+        The full paths handed to the workers are only made a batch at a
+        time, so the queue holds nothing but the entities themselves
+        """
+        if self.blockSize > 0:
+            hasher = hashFileBlocks
+        else:
+            hasher = hashFileJob
+        total_files = len(self.toHash)
+        total_bytes = sum([fe.size for fe in self.toHash])
+        pool = None
+        if self.jobs > 1 and total_files > 1:
+            if self.useThreads:
+                pool = ThreadPool(self.jobs)
+            else:
+                pool = Pool(self.jobs)
+        done = 0
+        hashed = 0
+        try:
+            for start in xrange(0, total_files, __HASH_BATCH__):
+                batch = self.toHash[start:start + __HASH_BATCH__]
+                jobs = [self.hashJob(fe) for fe in batch]
+                if pool is None:
+                    digests = (hasher(job) for job in jobs)
+                else:
+                    # imap keeps results in submission order
+                    digests = pool.imap(hasher, jobs, chunksize=16)
+                # izip so progress is reported as each digest arrives
+                for (fe, digest) in izip(batch, digests):
+                    if self.blockSize > 0:
+                        (digest, blocks) = digest
+                        self.blocks[os.path.join(fe.path, fe.name)] = blocks
+                    fe.hashd = digest
+                    done += fe.size
+                    hashed += 1
+                    if self.progress is not None:
+                        self.progress('hash', hashed, total_files, done, total_bytes)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.metrics.count('files_hashed', total_files)
+        self.metrics.count('bytes_hashed', total_bytes)
+        self.toHash = []
+
+    def hashJob(self, fe):
+        """The worker job for an entity waiting in self.toHash"""
+        full_path = os.path.join(self.root, fe.path, fe.name)
+        if self.blockSize > 0:
+            return (full_path, self.blockSize, self.hashAlgorithm)
+        return (full_path, self.hashAlgorithm, self.readStrategy)
+
+    def hashfile(self, fileName, blocksize=__READ_SIZE__):
         """Hash a file and return the digest"""
-        hasher = hashlib.sha256()
-        with open(fileName) as fh:
-            buf = fh.read(blocksize)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = fh.read(blocksize)
-            return hasher.hexdigest()
-        return "?"
+        return hashFile(fileName, self.hashAlgorithm, self.readStrategy, blocksize)
 
 ###############################################################################
 ###############################################################################
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    mirrors.py                                                               #
+#                                                                             #
+#    Share downloads between several mirrors of the same source               #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__SEGMENT_SIZE__ = 8 * 1024 * 1024  # files larger than this are split between mirrors
+__SLOW__ = 0.1                      # mirrors slower than this fraction of the fastest only stand by
+__MIN_STEAL__ = 1024 * 1024         # smallest unfinished range worth handing to another mirror
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import time
+import zlib
+import urllib2
+import urlparse
+import hashlib
+import threading
+
+# local includes
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class Mirror(object):
+    """One location serving a copy of the source
+
+    rate is how quickly (1 / seconds) it answered the probe for its
+    manifest. That is mostly latency, which is still a fair way to rank
+    hosts
+    """
+    def __init__(self, source, rate=None):
+        self.source = source
+        self.rate = rate
+        url = urlparse.urlsplit(source)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.basePath = url.path
+
+class Segment(object):
+    """One byte range (start and end inclusive) of a SegmentedFile
+
+    position is the next byte to fetch. end can be moved back while the
+    range is being fetched when another worker takes over the rest of it.
+    Both are guarded by the parent's lock
+    """
+    def __init__(self, parent, start, end):
+        self.parent = parent
+        self.start = start
+        self.end = end
+        self.position = start
+        self.started = None                 # (time, position) when the current fetch began
+
+    def remaining(self):
+        return self.end - self.position + 1
+
+    def rate(self):
+        """Bytes / second of the current fetch, None if it hasn't started"""
+        if self.started is None:
+            return None
+        return (self.position - self.started[1]) / max(time.time() - self.started[0], 1e-6)
+
+    def steal(self):
+        """Hand the second half of what is left to a new Segment
+
+        returns the new Segment, or None if there isn't enough left
+        """
+        with self.parent.lock:
+            if self.remaining() < __MIN_STEAL__:
+                return None
+            middle = self.position + self.remaining() // 2
+            stolen = Segment(self.parent, middle, self.end)
+            self.end = middle - 1
+            self.parent.pending += 1
+        return stolen
+
+class SegmentedFile(object):
+    """A large file fetched as several ranges, each possibly from a different mirror
+
+    The ranges are written straight into place in partPath. Whoever
+    finishes the last one checks the whole file against the manifest hash
+    """
+    def __init__(self, job, size, partPath, segmentSize):
+        self.job = job
+        self.size = size
+        self.partPath = partPath
+        self.segments = [Segment(self, start, min(start + segmentSize, size) - 1) for start in xrange(0, size, segmentSize)]
+        self.pending = len(self.segments)
+        self.error = None
+        self.lock = threading.Lock()
+
+    def finish(self, error=None):
+        """Mark one segment as done (or failed)
+
+        returns True for the last one
+        """
+        with self.lock:
+            if error is not None and self.error is None:
+                self.error = error
+            self.pending -= 1
+            return self.pending == 0
+
+def probeMirrors(sources, manifestName, timeout=30, known=None):
+    """Ask every location for its manifest at once
+
+    The first location is the source itself and is always kept. The others
+    are only kept if they list exactly the same entries. known is
+    {location => (digest, validators)} from earlier probes (the source's
+    own entry can come from a local copy of its manifest). Those requests
+    are conditional, so a manifest is only fetched again if it has changed.
+    returns ([Mirror] fastest first, [(location, reason)] for those dropped,
+             {location => (digest, validators)} for the next probe)
+    """
+    if known is None:
+        known = {}
+    results = [None] * len(sources)
+
+    def probe(i):
+        results[i] = probeManifest(sources[i] + manifestName, timeout, known.get(sources[i]))
+
+    threads = []
+    for i in range(len(sources)):
+        t = threading.Thread(target=probe, args=(i,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    probed = dict([(source, (digest, validators)) for (source, (digest, rate, validators)) in zip(sources, results)
+                   if digest is not None])
+    (expected, rate, validators) = results[0]
+    if expected is None:
+        # nothing to check the others against
+        return ([Mirror(sources[0])], [(s, "could not check %s (%s)" % (sources[0], rate)) for s in sources[1:]], probed)
+    mirrors = [Mirror(sources[0], rate)]
+    dropped = []
+    for (source, (digest, rate, validators)) in zip(sources[1:], results[1:]):
+        if digest is None:
+            dropped.append((source, rate))
+        elif digest != expected:
+            dropped.append((source, "manifest does not match %s" % sources[0]))
+        else:
+            mirrors.append(Mirror(source, rate))
+    mirrors.sort(key=lambda m: -m.rate)
+    return (mirrors, dropped, probed)
+
+def probeManifest(url, timeout=30, known=None):
+    """Time a request for a manifest and hash the entries in it
+
+    A gzipped copy (url + ".gz") is preferred. known is (digest, validators)
+    from an earlier probe; the request then carries its ETag and
+    Last-Modified and if the server answers 304 the old digest stands
+    without the manifest being fetched.
+    returns (digest, 1 / seconds to answer, validators) or (None, error message, None)
+    """
+    candidates = [url + ".gz", url]
+    validators = {}
+    if known is not None:
+        validators = known[1]
+        if validators.get('url') in candidates:
+            # ask for whatever was there last time first
+            candidates.remove(validators['url'])
+            candidates.insert(0, validators['url'])
+    try:
+        for candidate in candidates:
+            start = time.time()
+            request = urllib2.Request(candidate, headers={'Accept-Encoding': 'gzip'})
+            if validators.get('url') == candidate:
+                if 'etag' in validators:
+                    request.add_header('If-None-Match', validators['etag'])
+                if 'last-modified' in validators:
+                    request.add_header('If-Modified-Since', validators['last-modified'])
+            try:
+                response = urllib2.urlopen(request, None, timeout)
+            except urllib2.HTTPError as e:
+                if e.code == 304:
+                    return (known[0], 1.0 / max(time.time() - start, 1e-6), validators)
+                if candidate != candidates[-1]:
+                    # as for the source (see openSourceManifest), try the next name
+                    continue
+                raise
+            break
+        rate = 1.0 / max(time.time() - start, 1e-6)
+        validators = {'url': candidate}
+        for header in ['etag', 'last-modified']:
+            if response.info().get(header) is not None:
+                validators[header] = response.info().get(header)
+        gzipped = candidate.endswith(".gz") or response.info().get('Content-Encoding') == 'gzip'
+        try:
+            digest = entriesDigest(response, gzipped)
+        finally:
+            response.close()
+    except (urllib2.URLError, EnvironmentError, zlib.error) as e:
+        return (None, str(e), None)
+    return (digest, rate, validators)
+
+def entriesDigest(in_fh, gzipped=False):
+    """Hash the entries of a manifest read from an open file (or url) handle
+
+    The header is left out so that mirrors made by different versions
+    still agree
+    """
+    decompressor = None
+    if gzipped:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    hasher = hashlib.sha256()
+    header = True
+    buf = in_fh.read(65536)
+    while len(buf) > 0:
+        if decompressor is not None:
+            buf = decompressor.decompress(buf)
+        if header and "\n" in buf:
+            buf = buf[buf.index("\n") + 1:]
+            header = False
+        if not header:
+            hasher.update(buf)
+        buf = in_fh.read(65536)
+    if decompressor is not None:
+        hasher.update(decompressor.flush())
+    return hasher.hexdigest()
+
+def allocateConnections(mirrors, count):
+    """Share count connections between mirrors
+
+    Every mirror within reach of the fastest gets at least one (if there
+    are enough to go round) and the rest are shared in proportion to speed.
+    Workers all take jobs from one queue, so faster mirrors end up with more
+    files as well as more connections.
+    returns a list of count mirrors
+    """
+    best = max([m.rate for m in mirrors])
+    if best is None:
+        usable = mirrors
+        rates = [1.0] * len(mirrors)
+    else:
+        usable = [m for m in mirrors if m.rate is not None and m.rate >= best * __SLOW__]
+        rates = [float(m.rate) for m in usable]
+    if count <= len(usable):
+        return usable[:count]
+    shares = [(count - len(usable)) * r / sum(rates) for r in rates]
+    allocation = [1 + int(s) for s in shares]
+    # hand out what rounding left over by largest remainder
+    by_remainder = sorted(range(len(usable)), key=lambda i: int(shares[i]) - shares[i])
+    for i in by_remainder[:count - sum(allocation)]:
+        allocation[i] += 1
+    result = []
+    for (mirror, n) in zip(usable, allocation):
+        result.extend([mirror] * n)
+    return result
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -0,0 +1,655 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    pipeline.py                                                              #
+#                                                                             #
+#    Update a local tree with overlapping stages joined by bounded queues     #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__QUEUE_SIZE__ = 1024        # items held between two stages before the first one waits
+__BATCH_SIZE__ = 256         # bundle eligible files planned together
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import shutil
+import urllib2
+import threading
+import Queue
+
+# local includes
+from screamingbackpack.manifestManager import ManifestOrderError, __MANIFEST__, __STATCACHE__, __TEMPORARY__
+from screamingbackpack.downloader import Downloader
+from screamingbackpack.localReuse import LocalReuser
+from screamingbackpack.bundles import BundleRun, planRuns, __BUNDLES__, __PACKS__
+from screamingbackpack.binaryManifest import __BINARY__
+from screamingbackpack.deltaSync import __SIGNATURES__
+from screamingbackpack.mirrors import __SEGMENT_SIZE__
+from screamingbackpack.hashing import __DEFAULT_HASH__, __DEFAULT_READ__
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class PipelineAbort(Exception):
+    """Raised inside a stage to stop the update"""
+    pass
+
+class UpdatePipeline(object):
+    """Update a local tree from a source as a pipeline of stages
+
+        stream -> diff -> plan -> transfer -> verify -> record
+
+    Each stage runs in its own thread (transfer uses one per connection)
+    and passes work on through a bounded queue, so downloads start as soon
+    as the first change is found and overlap reading and diffing the rest
+    of the manifest. A None on a queue means the stage before it is done.
+
+    Deletions wait until everything else has finished. The new local
+    manifest is written from the old one and the verified results rather
+    than by rescanning the tree.
+    """
+    def __init__(self,
+                 manager,
+                 localManifestLocation,
+                 sourceManifestLocation,
+                 localManifestName=None,
+                 sourceManifestName=None,
+                 download=True,
+                 delete=True,
+                 reuse='reflink',
+                 store=None,
+                 mirrors=None,
+                 segmentSize=__SEGMENT_SIZE__,
+                 queueSize=__QUEUE_SIZE__):
+        if localManifestName is None:
+            localManifestName = __MANIFEST__
+        if sourceManifestName is None:
+            sourceManifestName = __MANIFEST__
+        self.MM = manager
+        self.localLocation = localManifestLocation
+        self.sourceLocation = sourceManifestLocation
+        self.localName = localManifestName
+        self.sourceName = sourceManifestName
+        self.localManifest = os.path.join(localManifestLocation, localManifestName)
+        self.download = download
+        self.delete = delete
+        self.reuse = reuse
+        self.store = store
+        self.mirrors = mirrors
+        self.segmentSize = segmentSize
+
+        self.lines = Queue.Queue(queueSize)     # batches of source manifest lines
+        self.changes = Queue.Queue(queueSize)   # (change, path, hash, size) from the diff
+        self.work = Queue.Queue(queueSize)      # download jobs and BundleRuns
+        self.fetched = Queue.Queue(queueSize)   # (job, error) waiting to be verified
+        self.verified = Queue.Queue(queueSize)  # (path, hash, size, stat) to record
+
+        self.source = None                      # url or folder the files come from
+        self.sourcePath = None                  # full copy of the source manifest on disk
+        self.chunks = None                      # the source manifest as it arrives
+        self.downloader = None
+        self.workers = None                     # download threads, started with the first transfer
+        self.waiting = []                       # jobs and BundleRuns planned before the workers start
+        self.streamed = threading.Event()       # the whole source manifest has been read
+        self.reuser = None
+        self.packs = None                       # folder of the source's bundles
+        self.bundled = {}                       # {path => (bundle, offset, size)} for planned files
+        self.expected = {}                      # {path => (hash, size)} for everything planned
+        self.deleted = []                       # paths the source no longer has
+        self.duplicates = []                    # jobs whose content is being fetched for another path
+        self.recorded = {}                      # {path => (hash, size, stat)} verified and in place
+        self.addedDirs = {}                     # {path => (hash, size)} folders made
+        self.errors = []                        # (path, message)
+        self.failed = False                     # a stage gave up
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Run the update
+
+        returns True if every change was applied
+        """
+        try:
+            if not self.openSource():
+                return False
+        except PipelineAbort:
+            return False
+        if self.chunks is None:
+            # neither manifest has changed since they last matched
+            return True
+
+        stages = [self.startStage('stream', self.stream),
+                  self.startStage('diff', self.diff),
+                  self.startStage('plan', self.plan)]
+        verifier = self.startStage('verify', self.verify)
+        recorder = self.startStage('record', self.record)
+        with self.MM.metrics.phase('transfer'):
+            for t in stages:
+                t.join()
+            # plan has finished, so the workers (if any) have started
+            for t in self.workers or []:
+                t.join()
+        self.fetched.put(None)
+        verifier.join()
+        self.verified.put(None)
+        recorder.join()
+        if self.failed:
+            return False
+
+        self.finishDuplicates()
+        if self.delete:
+            self.deleteAll()
+        self.MM.metrics.count('files_downloaded', self.downloader.filesDone)
+        self.MM.metrics.count('bytes_downloaded', self.downloader.bytesDone)
+        self.MM.metrics.count('bytes_delta_reused', self.downloader.bytesReused)
+        self.MM.metrics.count('files_segmented', self.downloader.filesSegmented)
+        self.MM.metrics.count('download_errors', len(self.errors))
+        if self.downloader.bytesReused > 0:
+            print "Delta sync reused %s of existing data" % self.MM.formatData(self.downloader.bytesReused)
+        if len(self.errors) > 0:
+            print "****************************************************************"
+            print "Error: %d file(s) could not be downloaded" % len(self.errors)
+            for (path, msg) in self.errors:
+                print "\t".join([path, msg])
+
+        changed = len(self.recorded) + len(self.addedDirs)
+        if self.delete:
+            changed += len(self.deleted)
+        if changed > 0:
+            print "writing manifest file"
+            with self.MM.metrics.phase('record'):
+                self.writeManifest()
+        if self.isComplete():
+            self.MM.markClean(self.localLocation, self.localName)
+        return len(self.errors) == 0
+
+    def isComplete(self):
+        """True if the local tree now matches the source"""
+        return self.download and (self.delete or len(self.deleted) == 0) and len(self.errors) == 0
+
+    def startStage(self, name, target):
+        t = threading.Thread(target=self.runStage, args=(name, target))
+        t.daemon = True
+        t.start()
+        return t
+
+    def runStage(self, name, target):
+        """Run one stage, making sure the stages after it are never left waiting"""
+        with self.MM.metrics.phase(name):
+            try:
+                target()
+            except PipelineAbort:
+                self.failed = True
+            except Exception:
+                self.failed = True
+                raise
+            finally:
+                if self.failed:
+                    self.abort()
+
+    def abort(self):
+        """Let every stage run down. Jobs already queued are thrown away"""
+        for q in [self.lines, self.changes, self.work]:
+            while True:
+                try:
+                    q.get_nowait()
+                except Queue.Empty:
+                    break
+        for q in [self.lines, self.changes]:
+            try:
+                q.put_nowait(None)
+            except Queue.Full:
+                pass
+        for i in range(self.MM.connections):
+            try:
+                self.work.put_nowait(None)
+            except Queue.Full:
+                pass
+
+    def put(self, q, item):
+        """Put item on q unless the pipeline has failed, then nobody may be listening"""
+        while not self.failed:
+            try:
+                q.put(item, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def drain(self, q):
+        """Yield every item off q until the None which ends it"""
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            yield item
+
+#-----------------------------------------------------------------------------
+# stream
+
+    def openSource(self):
+        """Work out where the source manifest is coming from
+
+        returns False if the source can't be reached
+        """
+        self.MM.sourceCache = None
+        try:
+            with self.MM.metrics.phase('fetch'):
+                (response, cache_path, meta) = self.MM.openSourceManifest(self.sourceLocation + "/" + self.sourceName,
+                                                                          self.localManifest)
+            self.source = self.sourceLocation + "/"
+            self.sourcePath = cache_path
+            if response is None:
+                if self.MM.isKnownClean(self.localLocation, self.localName):
+                    return True
+                self.chunks = self.readChunks(cache_path)
+            else:
+                self.chunks = self.MM.streamSourceManifest(response, cache_path, meta)
+        except ValueError:
+            # then it is probably a file
+            self.source = os.path.join(self.sourceLocation) + os.path.sep
+            self.sourcePath = os.path.join(self.sourceLocation, self.sourceName)
+            self.chunks = self.readChunks(self.sourcePath)
+        except urllib2.URLError:
+            print "Error: failed to connect to server."
+            return False
+        self.downloader = Downloader(self.source,
+                                     connections=self.MM.connections,
+                                     timeout=self.MM.timeout,
+                                     progress=self.MM.progress,
+                                     segmentSize=self.segmentSize)
+        return True
+
+    def readChunks(self, fileName, size=65536):
+        with open(fileName) as fh:
+            buf = fh.read(size)
+            while len(buf) > 0:
+                yield buf
+                buf = fh.read(size)
+
+    def stream(self):
+        """Split the source manifest into batches of lines as it arrives"""
+        pending = ""
+        try:
+            for chunk in self.chunks:
+                lines = (pending + chunk).split("\n")
+                pending = lines.pop()
+                if len(lines) > 0:
+                    self.put(self.lines, lines)
+            if len(pending) > 0:
+                self.put(self.lines, [pending])
+        finally:
+            self.streamed.set()
+            self.put(self.lines, None)
+
+#-----------------------------------------------------------------------------
+# diff
+
+    def sourceLines(self):
+        for batch in self.drain(self.lines):
+            for line in batch:
+                if len(line) > 0:
+                    yield line
+
+    def diff(self):
+        """Compare the manifests and pass every addition and modification on"""
+        try:
+            lines = self.sourceLines()
+            self.checkHeaders(next(lines, ""))
+            emitted = set()
+            try:
+                if not self.MM.isSortedManifest(self.localManifest):
+                    # the merge-join can report files as added before it
+                    # finds out the local side is unsorted. With a sorted
+                    # local side anything it passes on before an order
+                    # error in the source is a real change
+                    raise ManifestOrderError("the local manifest is not in path order")
+                with open(self.localManifest) as l_man:
+                    for change in self.MM.iterDiffs(self.MM.iterManifest(l_man), self.MM.iterManifest(lines)):
+                        if change[0] == 'deleted':
+                            self.deleted.append(change[1])
+                        else:
+                            emitted.add(change[1])
+                            self.put(self.changes, change)
+            except ManifestOrderError:
+                # older manifests are in walk order, wait for the whole
+                # thing and compare it the slow way
+                for line in lines:
+                    pass
+                if self.failed:
+                    raise PipelineAbort()
+                self.deleted = []
+                with open(self.localManifest) as l_man:
+                    with open(self.sourcePath) as s_man:
+                        changes = self.MM.iterUnsortedDiffs(self.MM.iterManifest(l_man, checkOrder=False),
+                                                            self.MM.iterManifest(s_man, checkOrder=False))
+                        for change in changes:
+                            if change[0] == 'deleted':
+                                self.deleted.append(change[1])
+                            elif change[1] not in emitted:
+                                self.put(self.changes, change)
+        finally:
+            self.put(self.changes, None)
+        self.MM.metrics.count('entries_deleted', len(self.deleted))
+
+    def checkHeaders(self, sourceHeader):
+        """Make sure the manifests can be compared, raises PipelineAbort if not"""
+        with open(self.localManifest) as l_man:
+            local_header = l_man.readline()
+        if not self.MM.compareHeaders(local_header, sourceHeader):
+            raise PipelineAbort()
+        s_hash = self.MM.sourceOptions.get('hash', __DEFAULT_HASH__)
+        self.downloader.hashAlgorithm = s_hash
+        self.downloader.signatureAlgorithm = s_hash
+
+#-----------------------------------------------------------------------------
+# plan
+
+    def plan(self):
+        """Decide how each change is satisfied
+
+        Folders are made straight away, content already on disk is reused
+        and everything else is queued for download. Small files are
+        gathered up so they can be taken from the source's bundles.
+        """
+        try:
+            if not self.download:
+                for change in self.drain(self.changes):
+                    pass
+                return
+            queued = set()
+            batch = []
+            for window in self.windows(self.changes):
+                self.loadExtras(window)
+                for (change, path, hashd, size) in window:
+                    full_path = os.path.abspath(os.path.join(self.localLocation, path))
+                    if change == 'addedDir':
+                        self.MM.makeSurePathExists(full_path)
+                        self.addedDirs[path] = (hashd, size)
+                        self.MM.metrics.count('folders_added')
+                        continue
+                    self.MM.metrics.count('files_added' if change == 'added' else 'files_modified')
+                    self.MM.makeSurePathExists(os.path.dirname(full_path))
+                    job = (path, full_path, hashd)
+                    self.expected[path] = (hashd, int(size))
+                    if self.reuser is not None and self.MM.reuseOne(self.reuser, path, full_path, hashd):
+                        self.MM.metrics.count('files_reused')
+                        self.put(self.fetched, (job, None))
+                    elif hashd in queued:
+                        # same content as another download, copy it afterwards
+                        self.duplicates.append(job)
+                    else:
+                        queued.add(hashd)
+                        self.downloader.sizes[path] = int(size)
+                        if path in self.bundled:
+                            batch.append(job)
+                            if len(batch) >= __BATCH_SIZE__:
+                                self.queueBatch(batch)
+                                batch = []
+                        else:
+                            self.queueWork(job)
+            self.queueBatch(batch)
+            if len(self.waiting) > 0:
+                # the diff is done, so the manifest has all arrived
+                self.streamed.wait()
+                self.startTransfer()
+        finally:
+            for i in range(self.MM.connections):
+                self.put(self.work, None)
+        if self.reuser is not None:
+            self.MM.metrics.count('bytes_reused', self.reuser.bytesReused)
+
+    def windows(self, q):
+        """Yield the items off q in lists until the None which ends it
+
+        The lists double in size (1, 2, 4, ...) so the first change is
+        planned straight away, yet the sidecars are only read for
+        log2(changes) lists rather than for every change
+        """
+        size = 1
+        window = []
+        for item in self.drain(q):
+            window.append(item)
+            if len(window) == size:
+                yield window
+                window = []
+                size *= 2
+        if len(window) > 0:
+            yield window
+
+    def loadExtras(self, window):
+        """Find what the changes in window can use: local copies of their
+        content, block signatures and places in the source's bundles
+
+        Only what the window needs is kept, see ManifestManager.indexLocal,
+        loadRemoteSignatures and loadBundleIndex
+        """
+        if self.reuser is None and (self.reuse is not None or self.store is not None):
+            algorithm = self.MM.sourceOptions.get('hash', __DEFAULT_HASH__)
+            self.reuser = LocalReuser(self.localLocation, mode=self.reuse, store=self.store, hashAlgorithm=algorithm)
+        files = [c for c in window if c[0] != 'addedDir']
+        if len(files) == 0:
+            return
+        if self.reuser is not None:
+            self.MM.indexLocal(self.reuser, self.localManifest, set([c[2] for c in files]))
+        if not self.downloader.isHttp():
+            return
+        modified = dict([(c[1], int(c[3])) for c in files if c[0] == 'modified'])
+        if len(modified) > 0:
+            self.MM.loadRemoteSignatures(self.downloader, self.source, self.sourceName, modified)
+        (packs, bundled) = self.MM.loadBundleIndex(self.source, self.sourceName, set([c[1] for c in files]))
+        if packs is not None:
+            self.packs = packs
+            self.bundled.update(bundled)
+
+    def queueBatch(self, batch):
+        (runs, remaining) = planRuns(self.packs, self.bundled, batch)
+        self.MM.metrics.count('bundle_requests', len(runs))
+        for run in runs:
+            self.queueWork(run)
+        for job in remaining:
+            self.queueWork(job)
+
+    def queueWork(self, job):
+        """Hand a job (or BundleRun) to the download workers
+
+        The workers are started with the first one (see startTransfer).
+        Mirrors are checked against the whole source manifest, so when
+        there are any, jobs wait in self.waiting until it has all arrived
+        (the stages feeding this one can't be held up)
+        """
+        if self.workers is None:
+            self.waiting.append(job)
+            if self.mirrors and not self.streamed.is_set():
+                return
+            self.startTransfer()
+            return
+        if isinstance(job, BundleRun):
+            self.put(self.work, job)
+            return
+        for item in self.downloader.split(job):
+            self.put(self.work, item)
+
+    def startTransfer(self):
+        """Probe the mirrors, start the workers and queue whatever was waiting
+
+        Only called once there is something to fetch, so updates with
+        nothing to download never probe the mirrors
+        """
+        mirrors = self.MM.findMirrors(self.source, self.mirrors, self.sourceName)
+        if mirrors:
+            self.downloader.mirrors = mirrors
+        self.workers = self.downloader.startWorkers(self.work, self.report)
+        (waiting, self.waiting) = (self.waiting, [])
+        for job in waiting:
+            self.queueWork(job)
+
+#-----------------------------------------------------------------------------
+# transfer, verify and record
+
+    def report(self, job, error):
+        """Called by the download workers once for every file"""
+        self.put(self.fetched, (job, error))
+
+    def verify(self):
+        """Check that every file is in place with the size the source gave"""
+        for ((path, full_path, hashd), error) in self.drain(self.fetched):
+            if error is None:
+                try:
+                    st = os.stat(full_path)
+                    if st.st_size != self.expected[path][1]:
+                        error = "expected %d bytes but found %d" % (self.expected[path][1], st.st_size)
+                except OSError as e:
+                    error = str(e)
+            if error is not None:
+                with self.lock:
+                    self.errors.append((path, error))
+                continue
+            self.put(self.verified, (path, hashd, self.expected[path][1], st))
+
+    def record(self):
+        """Remember verified files so the manifest can be written without a rescan"""
+        for (path, hashd, size, st) in self.drain(self.verified):
+            self.recorded[path] = (hashd, size, st)
+            if self.reuser is not None:
+                self.reuser.addToStore(hashd, os.path.join(self.localLocation, path))
+                self.reuser.index.setdefault(hashd, []).append(path)
+
+#-----------------------------------------------------------------------------
+# finishing up
+
+    def finishDuplicates(self):
+        """Copy content which was fetched once for several paths"""
+        for (path, full_path, hashd) in self.duplicates:
+            if self.reuser is not None and self.MM.reuseOne(self.reuser, path, full_path, hashd):
+                self.recorded[path] = (hashd, self.expected[path][1], os.stat(full_path))
+            else:
+                self.errors.append((path, "duplicate content could not be copied"))
+
+    def deleteAll(self):
+        with self.MM.metrics.phase('delete'):
+            for delete in self.deleted:
+                full_path = os.path.abspath(os.path.join(self.localLocation, delete))
+                if os.path.isfile(full_path):
+                    # full paths, as updateManifest prints
+                    print full_path
+                    os.remove(full_path)
+                    self.MM.metrics.count('files_deleted')
+                elif os.path.isdir(full_path):
+                    shutil.rmtree(full_path, ignore_errors=True)
+                    self.MM.metrics.count('folders_deleted')
+
+    def writeManifest(self):
+        """Write the new local manifest (and stat cache) from what was verified
+
+        If the tree now matches the source the source manifest is used as
+        is. Otherwise the old local manifest is patched with the changes
+        that were made; folder hashes can't be trusted then so they are
+        written as plain folders.
+        """
+        complete = self.isComplete()
+        merkle = complete and self.MM.sourceOptions.get('dirs') == 'merkle'
+        if complete:
+            with open(self.sourcePath) as s_man:
+                entries = dict([(e[0], (e[1], e[2])) for e in self.MM.iterManifest(s_man, checkOrder=False)])
+        else:
+            with open(self.localManifest) as l_man:
+                entries = dict([(e[0], (e[1], e[2])) for e in self.MM.iterManifest(l_man, checkOrder=False)])
+            if self.delete:
+                removed = set(self.deleted)
+                for path in entries.keys():
+                    if path in removed or self.isBelow(path, removed):
+                        del entries[path]
+            for (path, (hashd, size)) in self.addedDirs.items():
+                entries[path] = ('-', size)
+            for (path, (hashd, size, st)) in self.recorded.items():
+                entries[path] = (hashd, str(size))
+            for path in entries.keys():
+                if entries[path][0][0] == '-':
+                    entries[path] = ('-', '0')
+
+        tmp_path = self.localManifest + __TEMPORARY__
+        with open(tmp_path, 'w') as man_fh:
+            man_fh.write(self.MM.makeHeader(merkle,
+                                            self.MM.sourceOptions.get('hash', __DEFAULT_HASH__),
+                                            self.MM.localOptions.get('read', __DEFAULT_READ__)))
+            for path in sorted(entries.keys()):
+                man_fh.write("%s\t%s\t%s\n" % (path, entries[path][0], entries[path][1]))
+        os.rename(tmp_path, self.localManifest)
+        self.updateStatCache(entries)
+        # keep the binary index in step; signatures and bundles can't be
+        # rebuilt without reading the files so they are dropped instead
+        if os.path.exists(self.localManifest + __BINARY__):
+            self.MM.writeBinaryIndex(self.localLocation,
+                                     self.localName,
+                                     [(path, hashd, int(size)) for (path, (hashd, size)) in sorted(entries.items())])
+        self.MM.removeSidecars(self.localLocation, self.localName, [__SIGNATURES__, __BUNDLES__, __PACKS__])
+
+    def isBelow(self, path, folders):
+        """True if any parent folder of path is in folders"""
+        head = os.path.dirname(path)
+        while len(head) > 0:
+            if head in folders:
+                return True
+            head = os.path.dirname(head)
+        return False
+
+    def updateStatCache(self, entries):
+        """Bring an existing stat cache up to date with the new manifest"""
+        stat_path = self.localManifest + __STATCACHE__
+        if not os.path.exists(stat_path):
+            return
+        stats = {}
+        with open(stat_path) as stat_fh:
+            for line in stat_fh:
+                if line[0] != "#":
+                    fields = line.rstrip().split("\t")
+                    stats[fields[0]] = tuple([int(x) for x in fields[1:4]])
+        for (path, (hashd, size, st)) in self.recorded.items():
+            stats[path] = self.MM.statKey(st)
+        with open(stat_path + __TEMPORARY__, 'w') as stat_fh:
+            stat_fh.write("##stat##\tpath\tsize\tmtime_ns\tinode\n")
+            for path in sorted(stats.keys()):
+                if path in entries:
+                    stat_fh.write("%s\t%d\t%d\t%d\n" % ((path,) + stats[path]))
+        os.rename(stat_path + __TEMPORARY__, stat_path)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
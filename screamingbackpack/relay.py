@@ -0,0 +1,591 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    relay.py                                                                 #
+#                                                                             #
+#    A caching relay so many clients can share one copy of a remote source    #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+__CACHE_SIZE__ = 10 * 1024 * 1024 * 1024   # bytes of content kept by the relay
+__REFRESH__ = 60                            # seconds before the upstream manifest is checked again
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import re
+import time
+import errno
+import socket
+import urllib
+import urllib2
+import urlparse
+import httplib
+import hashlib
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+
+# local includes
+from screamingbackpack.manifestManager import __MANIFEST__, __SOURCECACHE__
+from screamingbackpack.downloader import Connection, DownloadError, __PARTIAL__
+from screamingbackpack.deltaSync import __SIGNATURES__
+from screamingbackpack.hashing import newHasher, __DEFAULT_HASH__
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class RelayFetch(object):
+    """One upstream fetch which any number of clients can read while it runs
+
+    The data goes to partPath, which readers open and follow as received
+    grows. error is set if the fetch fails or the data doesn't match the
+    manifest hash
+    """
+    def __init__(self, relPath, hashd, size, partPath):
+        self.relPath = relPath
+        self.thread = None
+        self.hashd = hashd
+        self.size = size
+        self.partPath = partPath
+        self.received = 0
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def advance(self, amount):
+        with self.cond:
+            self.received += amount
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def waitFor(self, position):
+        """Block until the byte at position has arrived (or the fetch is over)
+
+        returns the number of bytes received, raises DownloadError if the fetch failed
+        """
+        with self.cond:
+            while self.received <= position and not self.done:
+                self.cond.wait()
+            if self.error is not None:
+                raise DownloadError(self.error)
+            return self.received
+
+    def waitDone(self):
+        """Block until the whole file has arrived and been checked"""
+        self.waitFor(self.size)
+
+class RelayCache(object):
+    """The upstream manifest plus a content addressed cache of the files in it
+
+    Content is stored as <cacheDir>/<hash[:2]>/<hash> (the same layout as a
+    shared content store) and evicted least recently used first once it
+    holds more than maxSize bytes. Every file is fetched from upstream at
+    most once however many clients ask for it at the same time, and checked
+    against the manifest hash before it is kept.
+    """
+    def __init__(self,
+                 manager,
+                 upstream,
+                 cacheDir,
+                 maxSize=__CACHE_SIZE__,
+                 manifestName=None,
+                 refresh=__REFRESH__,
+                 connections=4,
+                 timeout=30,
+                 retries=3,
+                 blocksize=65536):
+        if manifestName is None:
+            manifestName = __MANIFEST__
+        self.MM = manager
+        self.upstream = upstream.rstrip("/") + "/"
+        url = urlparse.urlsplit(self.upstream)
+        if url.scheme not in ['http', 'https']:
+            raise ValueError("the upstream source must be an http(s) url, not %s" % upstream)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.basePath = url.path
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.manifestName = manifestName
+        self.sidecarNames = [manifestName + __SIGNATURES__]
+        self.refresh = refresh
+        self.timeout = timeout
+        self.retries = retries
+        self.blocksize = blocksize
+
+        self.lock = threading.Lock()        # guards everything below
+        self.manifestLock = threading.Lock()    # one manifest (or sidecar) fetch at a time
+        self.checked = None                 # when the upstream manifest was last checked
+        self.manifestPath = None            # local copy of the upstream manifest
+        self.etag = None                    # quoted sha256 of the manifest
+        self.entries = {}                   # {path => (hash, size)} of every file in the manifest
+        self.hashAlgorithm = __DEFAULT_HASH__
+        self.sidecars = {}                  # {name => local copy, or None if upstream has none}
+        self.lru = OrderedDict()            # {hash => size} least recently used first
+        self.used = 0                       # bytes of content in the cache
+        self.inflight = {}                  # {hash => RelayFetch}
+        self.idle = Queue.Queue()           # upstream connections not in use
+        self.slots = threading.Semaphore(max(1, connections))
+        self.closed = False
+        self.loadCache()
+
+    def log(self, message):
+        print "%s\t%s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message)
+
+    def storePath(self, hashd):
+        return os.path.join(self.cacheDir, hashd[:2], hashd)
+
+    def partialPath(self, hashd):
+        return os.path.join(self.cacheDir, hashd[:2], "." + hashd + __PARTIAL__)
+
+    def loadCache(self):
+        """Pick up whatever earlier runs left in the cache, oldest first
+
+        Partial files can't be trusted (nobody is fetching them any more) so
+        they are removed
+        """
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        found = []
+        for prefix in os.listdir(self.cacheDir):
+            prefix_path = os.path.join(self.cacheDir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                full_path = os.path.join(prefix_path, name)
+                if name[0] == '.':
+                    os.remove(full_path)
+                    continue
+                st = os.stat(full_path)
+                found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        with self.lock:
+            for (mtime, hashd, size) in found:
+                self.lru[hashd] = size
+                self.used += size
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used content until the cache fits (hold the lock)
+
+        Anyone still reading a dropped file keeps their open handle. The
+        newest entry is always kept, even if it is larger than the cache
+        """
+        while self.used > self.maxSize and len(self.lru) > 1:
+            (hashd, size) = self.lru.popitem(last=False)
+            self.used -= size
+            try:
+                os.remove(self.storePath(hashd))
+            except OSError:
+                pass
+            self.MM.metrics.count('relay_evicted')
+            self.MM.metrics.count('relay_evicted_bytes', size)
+
+    def refreshManifest(self):
+        """Check the upstream manifest if it is more than refresh seconds old
+
+        If upstream can't be reached the last copy keeps being served
+        returns False if there is no manifest to serve
+        """
+        with self.manifestLock:
+            if self.checked is not None and time.time() - self.checked < self.refresh:
+                return True
+            local_manifest = os.path.join(self.cacheDir, self.manifestName)
+            try:
+                with self.MM.metrics.phase('fetch'):
+                    (man_fh, unchanged) = self.MM.fetchSourceManifest(self.upstream + self.manifestName, local_manifest)
+            except (urllib2.URLError, httplib.HTTPException, EnvironmentError) as e:
+                self.log("can't fetch the upstream manifest (%s)" % e)
+                self.checked = time.time()
+                copy_path = local_manifest + __SOURCECACHE__
+                if self.manifestPath is None and os.path.exists(copy_path):
+                    with open(copy_path) as man_fh:
+                        self.loadManifest(man_fh)
+                return self.manifestPath is not None
+            self.checked = time.time()
+            with man_fh:
+                if not unchanged or self.manifestPath is None:
+                    self.loadManifest(man_fh)
+            return True
+
+    def loadManifest(self, man_fh):
+        """Index the files in a (newly fetched) manifest"""
+        hasher = hashlib.sha256()
+        header = man_fh.readline()
+        hasher.update(header)
+        options = self.MM.getManOptions(header)
+        entries = {}
+        for line in man_fh:
+            hasher.update(line)
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3 or fields[1][0] == '-':
+                continue
+            entries[fields[0]] = (fields[1], int(fields[2]))
+        etag = '"%s"' % hasher.hexdigest()
+        with self.lock:
+            changed = etag != self.etag
+            self.entries = entries
+            self.hashAlgorithm = options.get('hash', __DEFAULT_HASH__)
+            self.etag = etag
+            self.manifestPath = man_fh.name
+            if changed:
+                # sidecars belong to the old manifest
+                self.sidecars = {}
+        if changed:
+            self.MM.metrics.count('relay_manifests')
+            self.log("upstream manifest lists %d file(s)" % len(entries))
+
+    def manifest(self):
+        """returns (open manifest, size, etag) or None if there isn't one"""
+        if not self.refreshManifest():
+            return None
+        with self.lock:
+            fh = open(self.manifestPath, 'rb')
+            return (fh, os.fstat(fh.fileno()).st_size, self.etag)
+
+    def sidecar(self, name):
+        """returns (open sidecar, size) or None if upstream doesn't publish it
+
+        Sidecars are fetched whole, once for each version of the manifest
+        """
+        if not self.refreshManifest():
+            return None
+        with self.manifestLock:
+            if name not in self.sidecars:
+                local_path = os.path.join(self.cacheDir, name)
+                try:
+                    in_fh = urllib2.urlopen(self.upstream + name, None, self.timeout)
+                    try:
+                        with open(local_path + ".tmp", 'wb') as out_fh:
+                            buf = in_fh.read(self.blocksize)
+                            while len(buf) > 0:
+                                out_fh.write(buf)
+                                buf = in_fh.read(self.blocksize)
+                    finally:
+                        in_fh.close()
+                    os.rename(local_path + ".tmp", local_path)
+                except (urllib2.URLError, httplib.HTTPException, EnvironmentError):
+                    local_path = None
+                with self.lock:
+                    self.sidecars[name] = local_path
+            local_path = self.sidecars[name]
+        if local_path is None:
+            return None
+        fh = open(local_path, 'rb')
+        return (fh, os.fstat(fh.fileno()).st_size)
+
+    def content(self, relPath):
+        """Find a file listed in the manifest
+
+        returns None if it isn't listed, otherwise (open file, size, fetch)
+        where fetch is the RelayFetch still filling the file, or None if
+        it is already in the cache
+        """
+        with self.lock:
+            if relPath not in self.entries:
+                return None
+            (hashd, size) = self.entries[relPath]
+            if hashd in self.lru:
+                try:
+                    fh = open(self.storePath(hashd), 'rb')
+                    os.utime(self.storePath(hashd), None)
+                    self.lru[hashd] = self.lru.pop(hashd)
+                    self.MM.metrics.count('relay_hits')
+                    return (fh, size, None)
+                except EnvironmentError:
+                    # removed behind our back
+                    self.used -= self.lru.pop(hashd)
+            fetch = self.inflight.get(hashd)
+            if fetch is None:
+                fetch = self.startFetch(relPath, hashd, size)
+            else:
+                self.MM.metrics.count('relay_coalesced')
+            return (open(fetch.partPath, 'rb'), size, fetch)
+
+    def startFetch(self, relPath, hashd, size):
+        """Start fetching a file from upstream in the background (hold the lock)
+
+        It runs on its own thread so it finishes even if the client which
+        asked for it goes away
+        """
+        try:
+            os.makedirs(os.path.dirname(self.partialPath(hashd)))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fetch = RelayFetch(relPath, hashd, size, self.partialPath(hashd))
+        open(fetch.partPath, 'wb').close()
+        self.inflight[hashd] = fetch
+        self.MM.metrics.count('relay_misses')
+        fetch.thread = threading.Thread(target=self.fetchUpstream, args=(fetch, self.hashAlgorithm))
+        fetch.thread.daemon = True
+        fetch.thread.start()
+        return fetch
+
+    def fetchUpstream(self, fetch, hashAlgorithm):
+        """Fetch a file and move it into the cache if it matches the manifest"""
+        # readers wait on this fetch, so it must always be finished
+        error = "relay error"
+        try:
+            self.download(fetch, hashAlgorithm)
+            error = None
+        except (DownloadError, httplib.HTTPException, socket.error, EnvironmentError) as e:
+            error = str(e)
+            self.log("can't fetch %s from upstream (%s)" % (fetch.relPath, error))
+        finally:
+            with self.lock:
+                del self.inflight[fetch.hashd]
+                if error is None:
+                    os.rename(fetch.partPath, self.storePath(fetch.hashd))
+                    self.lru[fetch.hashd] = fetch.size
+                    self.used += fetch.size
+                    self.evict()
+                else:
+                    os.remove(fetch.partPath)
+            fetch.finish(error)
+
+    def download(self, fetch, hashAlgorithm):
+        """GET the file, resuming with Range requests if the connection drops"""
+        hasher = newHasher(hashAlgorithm)
+        conn = self.takeConnection()
+        try:
+            for attempt in range(self.retries + 1):
+                headers = {}
+                if fetch.received > 0:
+                    headers['Range'] = "bytes=%d-" % fetch.received
+                try:
+                    response = conn.request(conn.basePath + urllib.quote(fetch.relPath), headers)
+                    if response.status not in [200, 206]:
+                        response.read()
+                        raise DownloadError("HTTP %d %s" % (response.status, response.reason))
+                    if response.status == 200 and fetch.received > 0:
+                        # the Range was ignored, skip what we already have
+                        remaining = fetch.received
+                        while remaining > 0:
+                            buf = response.read(min(remaining, self.blocksize))
+                            if len(buf) == 0:
+                                raise httplib.IncompleteRead("upstream ended %d bytes short of the resume point" % remaining)
+                            remaining -= len(buf)
+                    with open(fetch.partPath, 'ab') as out_fh:
+                        buf = response.read(self.blocksize)
+                        while len(buf) > 0:
+                            if self.closed:
+                                conn.close()
+                                raise DownloadError("the relay is stopping")
+                            if fetch.received + len(buf) > fetch.size:
+                                conn.close()
+                                raise DownloadError("larger than the manifest says")
+                            out_fh.write(buf)
+                            # readers follow the file, so it must be on disk first
+                            out_fh.flush()
+                            hasher.update(buf)
+                            fetch.advance(len(buf))
+                            self.MM.metrics.count('relay_upstream_bytes', len(buf))
+                            buf = response.read(self.blocksize)
+                    if fetch.received < fetch.size:
+                        raise httplib.IncompleteRead("%d of %d bytes" % (fetch.received, fetch.size))
+                    break
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    if attempt == self.retries:
+                        raise
+        finally:
+            self.giveConnection(conn)
+        if hasher.hexdigest() != fetch.hashd:
+            raise DownloadError("%s hash does not match the manifest" % hashAlgorithm)
+        self.MM.metrics.count('relay_upstream_files')
+
+    def close(self):
+        """Abandon any fetches still running and wait for them to stop"""
+        with self.lock:
+            self.closed = True
+            fetches = self.inflight.values()
+        for fetch in fetches:
+            fetch.thread.join(self.timeout)
+
+    def takeConnection(self):
+        """Wait for one of the upstream connections"""
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return Connection(self.scheme, self.netloc, self.timeout, self.basePath)
+
+    def giveConnection(self, conn):
+        self.idle.put(conn)
+        self.slots.release()
+
+class RelayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the manifest, its sidecars and the files it lists from the relay's cache
+
+    Byte ranges are supported everywhere. Files which are still arriving
+    from upstream are sent as they come in
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        cache = self.server.cache
+        cache.MM.metrics.count('relay_requests')
+        rel_path = urllib.unquote(self.path.split("?")[0]).lstrip("/")
+        try:
+            if rel_path == cache.manifestName:
+                found = cache.manifest()
+                if found is None:
+                    self.sendStatus(502)
+                    return
+                (fh, size, etag) = found
+                if self.headers.get('If-None-Match') == etag:
+                    fh.close()
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.sendFile(fh, size, etag=etag)
+            elif rel_path in cache.sidecarNames:
+                found = cache.sidecar(rel_path)
+                if found is None:
+                    self.sendStatus(404)
+                    return
+                self.sendFile(found[0], found[1])
+            else:
+                found = cache.content(rel_path)
+                if found is None:
+                    self.sendStatus(404)
+                    return
+                self.sendFile(found[0], found[1], fetch=found[2])
+        except socket.error:
+            # the client went away
+            self.close_connection = 1
+
+    def sendStatus(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def sendFile(self, fh, size, etag=None, fetch=None):
+        """Send all of fh, or the byte range asked for
+
+        If fetch is given, fh is still being filled: wait for each part to
+        arrive and for the whole file to be checked before the last byte
+        goes out. If that fails the connection is dropped part way through
+        """
+        try:
+            (start, end) = (0, size - 1)
+            match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get('Range', ""))
+            if match is not None and match.group(1) + match.group(2) != "":
+                if match.group(1) == "":
+                    start = max(0, size - int(match.group(2)))
+                else:
+                    start = int(match.group(1))
+                    if match.group(2) != "":
+                        end = min(end, int(match.group(2)))
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', "bytes */%d" % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            if fetch is not None:
+                try:
+                    # don't promise anything until upstream has answered
+                    fetch.waitFor(start)
+                except DownloadError:
+                    self.sendStatus(502)
+                    return
+            if match is not None and (start, end) != (0, size - 1):
+                self.send_response(206)
+                self.send_header('Content-Range', "bytes %d-%d/%d" % (start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start + 1))
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.end_headers()
+
+            fh.seek(start)
+            position = start
+            while position <= end:
+                available = end + 1
+                if fetch is not None:
+                    available = min(available, fetch.waitFor(position))
+                buf = fh.read(min(available - position, 65536))
+                if len(buf) == 0:
+                    break
+                if fetch is not None and position + len(buf) == size:
+                    fetch.waitDone()
+                self.wfile.write(buf)
+                position += len(buf)
+                self.server.cache.MM.metrics.count('relay_bytes_served', len(buf))
+            if position <= end:
+                self.close_connection = 1
+        except DownloadError:
+            self.close_connection = 1
+        finally:
+            fh.close()
+
+class RelayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Keep-alive HTTP server in front of a RelayCache"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cache, host='', port=8080):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), RelayRequestHandler)
+        self.cache = cache
+
+    def url(self):
+        (host, port) = self.server_address[:2]
+        if host in ['', '0.0.0.0']:
+            host = socket.getfqdn()
+        return "http://%s:%d" % (host, port)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    test_downloader.py                                                       #
+#                                                                             #
+#    Loopback tests for the keep-alive downloader                             #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+# local includes
+from screamingbackpack.downloader import Downloader, partialTargets
+from screamingbackpack.mirrors import Mirror
+from screamingbackpack.benchmark import SourceServer, SourceRequestHandler, writeRandomFile
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class ThrottledWriter(object):
+    """Write to fh at no more than rate bytes / second"""
+    def __init__(self, fh, rate):
+        self.fh = fh
+        self.rate = rate
+
+    def write(self, data):
+        time.sleep(len(data) / float(self.rate))
+        self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+class DroppingRequestHandler(SourceRequestHandler):
+    """Hang up half way through the first drops whole file transfers"""
+    def setup(self):
+        SourceRequestHandler.setup(self)
+        if self.server.rate is not None:
+            self.wfile = ThrottledWriter(self.wfile, self.server.rate)
+
+    def do_GET(self):
+        server = self.server
+        if 'Range' in self.headers:
+            server.ranges.append(self.headers['Range'])
+        elif server.drops > 0:
+            server.drops -= 1
+            path = os.path.join(server.root, self.path.lstrip("/"))
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:len(data) // 2])
+            self.wfile.flush()
+            self.close_connection = 1
+            return
+        SourceRequestHandler.do_GET(self)
+
+class CountingServer(SourceServer):
+    """A SourceServer which counts the connections made to it
+
+    rate limits how fast (bytes / second) each response is sent
+    """
+    def __init__(self, root, drops=0, latency=0.0, rate=None):
+        SourceServer.__init__(self, root, latency=latency)
+        self.RequestHandlerClass = DroppingRequestHandler
+        self.connections = 0
+        self.drops = drops
+        self.rate = rate
+        self.ranges = []
+
+    def handle_error(self, request, client_address):
+        # clients hang up on ranges which have been taken over by another mirror
+        pass
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        SourceServer.process_request(self, request, client_address)
+
+class DownloaderTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, "source")
+        self.local = os.path.join(self.root, "local")
+        os.makedirs(self.source)
+        os.makedirs(self.local)
+        self.server = None
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.root)
+
+    def serve(self, drops=0, latency=0.0, rate=None):
+        self.server = CountingServer(self.source, drops=drops, latency=latency, rate=rate)
+        self.server.start()
+        self.servers.append(self.server)
+        return self.server.url() + "/"
+
+    def addFile(self, name, size):
+        """Write a random source file, returns its download job"""
+        path = os.path.join(self.source, name)
+        writeRandomFile(path, size)
+        with open(path, 'rb') as fh:
+            hashd = hashlib.sha256(fh.read()).hexdigest()
+        return (name, os.path.join(self.local, name), hashd)
+
+    def assertFetched(self, job):
+        with open(os.path.join(self.source, job[0]), 'rb') as s_fh:
+            with open(job[1], 'rb') as l_fh:
+                self.assertEqual(s_fh.read(), l_fh.read())
+
+    def testConnectionReuse(self):
+        jobs = [self.addFile("f%d" % i, 1000 + i) for i in range(20)]
+        downloader = Downloader(self.serve(), connections=2)
+        self.assertEqual(downloader.fetchAll(jobs), [])
+        for job in jobs:
+            self.assertFetched(job)
+        self.assertEqual(self.server.requests, 20)
+        # one keep-alive connection per worker
+        self.assertEqual(self.server.connections, 2)
+
+    def testResumeAfterDrop(self):
+        job = self.addFile("big", 1024 * 1024)
+        downloader = Downloader(self.serve(drops=1), connections=1)
+        self.assertEqual(downloader.fetchAll([job]), [])
+        self.assertFetched(job)
+        # the second request only asked for what was missing
+        self.assertEqual(self.server.ranges, ["bytes=%d-" % (512 * 1024)])
+        self.assertFalse(os.path.exists(downloader.partialPath(job[1])))
+
+    def testSegmentStealing(self):
+        segment_size = 2 * 1024 * 1024
+        job = self.addFile("big", 4 * segment_size + 12345)
+        # the fast mirror's latency makes sure the slow one gets a segment
+        fast_url = self.serve(latency=0.05)
+        fast = self.server
+        slow_url = self.serve(rate=1024 * 1024)
+        slow = self.server
+        downloader = Downloader(fast_url,
+                                connections=2,
+                                mirrors=[Mirror(fast_url, 1.0), Mirror(slow_url, 1.0)],
+                                segmentSize=segment_size)
+        downloader.sizes[job[0]] = os.path.getsize(os.path.join(self.source, job[0]))
+        # fetchAll checks the hash of the whole file
+        self.assertEqual(downloader.fetchAll([job]), [])
+        self.assertFetched(job)
+        self.assertEqual(downloader.filesSegmented, 1)
+        self.assertTrue(len(slow.ranges) > 0)
+        # the fast mirror took over the end of a segment the slow one started
+        starts = [int(r[6:].split("-")[0]) for r in fast.ranges]
+        self.assertTrue(len([s for s in starts if s % segment_size != 0]) > 0)
+        self.assertFalse(os.path.exists(os.path.join(self.local, ".big.seg.sbpart")))
+
+    def testHashMismatch(self):
+        (name, local_path, hashd) = self.addFile("bad", 5000)
+        downloader = Downloader(self.serve(), connections=1)
+        errors = downloader.fetchAll([(name, local_path, "0" * 64)])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], name)
+        self.assertTrue("hash does not match" in errors[0][1])
+        # nothing is left behind for a later run to trust
+        self.assertFalse(os.path.exists(local_path))
+        self.assertFalse(os.path.exists(downloader.partialPath(local_path)))
+
+    def testPartialTargets(self):
+        downloader = Downloader("http://127.0.0.1/", connections=1)
+        local_path = os.path.join(self.local, "f")
+        self.assertEqual(partialTargets(os.path.basename(downloader.partialPath(local_path))), ["f"])
+        self.assertEqual(partialTargets(".f.seg.sbpart"), ["f.seg", "f"])
+        self.assertEqual(partialTargets(".f.reuse.sbpart"), ["f.reuse", "f"])
+        # not named like one of ours
+        self.assertEqual(partialTargets("f.sbpart"), [])
+        self.assertEqual(partialTargets(".sbpart"), [])
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+###############################################################################
+#                                                                             #
+#    watcher.py                                                               #
+#                                                                             #
+#    Keep a manifest up to date using inotify (linux)                         #
+#                                                                             #
+#    Copyright (C) Michael Imelfort                                           #
+#                                                                             #
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = "Michael Imelfort"
+__copyright__ = "Copyright 2014"
+__credits__ = ["Michael Imelfort"]
+__license__ = "GPLv3"
+__maintainer__ = "Michael Imelfort"
+__email__ = "mike@mikeimelfort.com"
+__version__ = "0.2.3"
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# inotify flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+# everything which can change what a folder holds
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# system includes
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# local includes
+from screamingbackpack.fileEntity import FileEntity as FE
+from screamingbackpack.manifestManager import __MANIFEST__
+from screamingbackpack.downloader import partialTargets
+from screamingbackpack.hashing import __DEFAULT_HASH__, __DEFAULT_READ__
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+class Inotify(object):
+    """Just enough of the linux inotify API, through ctypes
+
+    raises OSError if inotify isn't available
+    """
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self.raiseErrno("inotify_init1")
+
+    def raiseErrno(self, what):
+        code = ctypes.get_errno()
+        raise OSError(code, "%s: %s" % (what, os.strerror(code)))
+
+    def addWatch(self, path, mask):
+        """Watch path, returns the watch descriptor"""
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self.raiseErrno(path)
+        return wd
+
+    def removeWatch(self, wd):
+        # fails harmlessly if the folder has already gone
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for events
+
+        returns a list of (watch descriptor, mask, cookie, name)
+        """
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            (wd, mask, cookie, length) = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip("\0")
+            events.append((wd, mask, cookie, name))
+            offset += 16 + length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class ManifestWatcher(object):
+    """Keep the manifest of a folder current as the files in it change
+
+    The manifest is created once (incrementally, so restarting is cheap)
+    and inotify then reports what is touched. Once no events have arrived
+    for settle seconds, or maxDelay seconds after the first one if the
+    writes don't stop, only the touched paths are looked at again. The
+    entities of the last create are patched, the changed files re-hashed and
+    the manifest (and sidecars) rewritten. The tree is never walked again
+    unless the kernel drops events.
+    """
+    def __init__(self,
+                 manager,
+                 path,
+                 manifestName=None,
+                 settle=2.0,
+                 maxDelay=60.0,
+                 sortEntries=True,
+                 binaryIndex=False,
+                 merkle=False,
+                 hashAlgorithm=__DEFAULT_HASH__,
+                 readStrategy=__DEFAULT_READ__,
+                 blockSize=0,
+                 bundleSize=0,
+                 bundleFileSize=65536):
+        if manifestName is None:
+            manifestName = __MANIFEST__
+        self.MM = manager
+        self.root = os.path.abspath(path)
+        self.manifestName = manifestName
+        self.settle = settle
+        self.maxDelay = maxDelay
+        self.sortEntries = sortEntries
+        self.binaryIndex = binaryIndex
+        self.merkle = merkle
+        self.hashAlgorithm = hashAlgorithm
+        self.readStrategy = readStrategy
+        self.blockSize = blockSize
+        self.bundleSize = bundleSize
+        self.bundleFileSize = bundleFileSize
+        self.skip = manager.sidecarNames(manifestName)
+        self.inotify = None
+        self.watches = {}                   # {watch descriptor => relative folder path}
+        self.entities = {}                  # {relative path => FileEntity} from the last create
+        self.touched = set()                # relative paths with events since the last rewrite
+        self.overflow = False               # events were lost, everything must be looked at
+        self.firstEvent = None
+        self.lastEvent = None
+        self.warned = False
+
+    def run(self, rewrites=None):
+        """Create the manifest then keep it current (until interrupted)
+
+        rewrites stops after that many rewrites (for testing)
+        """
+        self.inotify = Inotify()
+        try:
+            # watch first so nothing is missed while the manifest is made
+            self.watchTree('')
+            self.create()
+            done = 0
+            while rewrites is None or done < rewrites:
+                for event in self.inotify.read(self.timeout()):
+                    self.handle(event)
+                if self.isSettled():
+                    self.refresh()
+                    done += 1
+        finally:
+            self.inotify.close()
+            self.inotify = None
+
+    def create(self):
+        """Make the manifest the usual way and index its entities"""
+        self.MM.createManifest(self.root,
+                               manifestName=self.manifestName,
+                               incremental=True,
+                               blockSize=self.blockSize,
+                               sortEntries=self.sortEntries,
+                               binaryIndex=self.binaryIndex,
+                               merkle=self.merkle,
+                               hashAlgorithm=self.hashAlgorithm,
+                               readStrategy=self.readStrategy,
+                               bundleSize=self.bundleSize,
+                               bundleFileSize=self.bundleFileSize)
+        # anything looked at from now on has been touched, so is re-hashed
+        self.MM.known = {}
+        self.entities = {}
+        self.index(self.MM.files)
+        print "%s\twatching %d entries under %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), len(self.entities), self.root)
+
+    def index(self, entities):
+        for f in entities:
+            if f.parent is None:
+                self.entities[''] = f
+            else:
+                self.entities[os.path.join(f.path, f.name)] = f
+
+#-----------------------------------------------------------------------------
+# events
+
+    def timeout(self):
+        """How long to wait for the next event"""
+        if self.lastEvent is None and not self.overflow:
+            return None
+        now = time.time()
+        return max(0.0, min(self.lastEvent + self.settle - now, self.firstEvent + self.maxDelay - now))
+
+    def isSettled(self):
+        if self.lastEvent is None:
+            return False
+        now = time.time()
+        return now - self.lastEvent >= self.settle or now - self.firstEvent >= self.maxDelay
+
+    def handle(self, event):
+        (wd, mask, cookie, name) = event
+        if mask & IN_Q_OVERFLOW:
+            self.overflow = True
+            self.noteEvent()
+            return
+        if mask & IN_IGNORED:
+            # the folder has gone
+            self.watches.pop(wd, None)
+            return
+        if wd not in self.watches or name == "":
+            return
+        folder = self.watches[wd]
+        if self.isSkipped(folder, name):
+            return
+        rel_path = os.path.join(folder, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watchTree(rel_path)
+            elif mask & IN_MOVED_FROM:
+                self.unwatchTree(rel_path)
+        self.touched.add(rel_path)
+        self.noteEvent()
+
+    def noteEvent(self):
+        self.lastEvent = time.time()
+        if self.firstEvent is None:
+            self.firstEvent = self.lastEvent
+
+    def isSkipped(self, folder, name):
+        """True for anything walk leaves out of the manifest"""
+        if folder == '' and name in self.skip:
+            return True
+        if name == __MANIFEST__:
+            return True
+        # partials are only skipped while the file they belong to is around
+        for target in partialTargets(name):
+            rel_path = os.path.join(folder, target)
+            if rel_path in self.entities or os.path.isfile(os.path.join(self.root, rel_path)):
+                return True
+        return False
+
+    def watchTree(self, relPath):
+        """Watch a folder and every folder below it"""
+        stack = [relPath]
+        while len(stack) > 0:
+            rel_path = stack.pop()
+            full_path = os.path.join(self.root, rel_path)
+            try:
+                wd = self.inotify.addWatch(full_path, WATCH_MASK | IN_ONLYDIR)
+                dirs = self.MM.scanDir(full_path)[0]
+            except OSError as e:
+                if e.errno == errno.ENOSPC and not self.warned:
+                    print "Warning: out of inotify watches, raise fs.inotify.max_user_watches. Some folders are not watched"
+                    self.warned = True
+                # otherwise it has gone again already
+                continue
+            self.watches[wd] = rel_path
+            for d in dirs:
+                if not self.isSkipped(rel_path, d):
+                    stack.append(os.path.join(rel_path, d))
+
+    def unwatchTree(self, relPath):
+        """Stop watching a folder which has moved away (and everything below it)"""
+        prefix = relPath + os.path.sep
+        for (wd, rel_path) in self.watches.items():
+            if rel_path == relPath or rel_path.startswith(prefix):
+                self.inotify.removeWatch(wd)
+                del self.watches[wd]
+
+#-----------------------------------------------------------------------------
+# updating the manifest
+
+    def refresh(self):
+        """Bring the manifest up to date with everything touched"""
+        touched = self.touched
+        self.touched = set()
+        self.firstEvent = None
+        self.lastEvent = None
+        if self.overflow:
+            # lost track, do it properly
+            self.overflow = False
+            print "%s\tevents were dropped, re-creating the manifest" % time.strftime("%Y-%m-%d %H:%M:%S")
+            self.create()
+            return
+        with self.MM.metrics.phase('refresh'):
+            removed = set()
+            moved = {}
+            # sorted so folders come before what is in them
+            for rel_path in sorted(touched):
+                self.update(rel_path, removed, moved)
+            if len(removed) > 0:
+                self.MM.files = [f for f in self.MM.files if id(f) not in removed]
+            self.reuseMoved(moved)
+            hashed = len(self.MM.toHash)
+            with self.MM.metrics.phase('hash'):
+                self.MM.hashPending()
+                dir_hashes = {}
+                if self.merkle:
+                    dir_hashes = self.MM.merkleHashes()
+            with self.MM.metrics.phase('write'):
+                self.MM.writeOutputs(self.root,
+                                     self.manifestName,
+                                     merkle=self.merkle,
+                                     dirHashes=dir_hashes,
+                                     sortEntries=self.sortEntries,
+                                     binaryIndex=self.binaryIndex,
+                                     statCache=True,
+                                     bundleSize=self.bundleSize,
+                                     bundleFileSize=self.bundleFileSize,
+                                     changed=touched)
+        self.MM.metrics.count('refreshes')
+        print "%s\t%d path(s) touched, %d file(s) re-hashed, %d removed, manifest rewritten" % (time.strftime("%Y-%m-%d %H:%M:%S"),
+                                                                                              len(touched),
+                                                                                              hashed,
+                                                                                              len(removed))
+
+    def reuseMoved(self, moved):
+        """Keep the hashes of files which have only been renamed
+
+        moved is {(size, mtime_ns, inode) => (hash, blocks)} of the files
+        removed this time round. A new path with the same stats is the same
+        file (as for incremental builds) so it doesn't need hashing again
+        """
+        pending = []
+        for fe in self.MM.toHash:
+            rel_path = os.path.join(fe.path, fe.name)
+            old = moved.get(self.MM.stats.get(rel_path))
+            if old is not None and (self.MM.blockSize == 0 or old[1] is not None):
+                fe.hashd = old[0]
+                if old[1] is not None:
+                    self.MM.blocks[rel_path] = old[1]
+            else:
+                pending.append(fe)
+        self.MM.metrics.count('files_moved', len(self.MM.toHash) - len(pending))
+        self.MM.toHash = pending
+
+    def update(self, relPath, removed, moved):
+        """Bring the entity for one path in line with the file system"""
+        full_path = os.path.join(self.root, relPath)
+        fe = self.entities.get(relPath)
+        if os.path.isdir(full_path):
+            if fe is not None and fe.hashd != '-':
+                # a file replaced by a folder
+                self.remove(relPath, removed, moved)
+                fe = None
+            if fe is None:
+                (head, tail) = os.path.split(relPath)
+                dir_fe = FE(tail, head, self.ensureDir(head), "-", 0)
+                start = len(self.MM.files)
+                self.MM.files.append(dir_fe)
+                # pick up whatever was put in it before it was watched
+                self.MM.walk(dir_fe, full_path, relPath=relPath)
+                self.index(self.MM.files[start:])
+        elif os.path.isfile(full_path):
+            if fe is not None and fe.hashd == '-':
+                self.remove(relPath, removed, moved)
+                fe = None
+            st = os.stat(full_path)
+            if fe is None:
+                (head, tail) = os.path.split(relPath)
+                start = len(self.MM.files)
+                self.MM.addFile(tail, head, self.ensureDir(head), st)
+                self.index(self.MM.files[start:])
+            elif self.MM.stats.get(relPath) != self.MM.statKey(st):
+                self.MM.stats[relPath] = self.MM.statKey(st)
+                fe.size = st.st_size
+                self.MM.toHash.append(fe)
+        elif fe is not None:
+            self.remove(relPath, removed, moved)
+
+    def ensureDir(self, relPath):
+        """The entity for a folder, made (with its parents) if need be"""
+        if relPath in self.entities:
+            return self.entities[relPath]
+        (head, tail) = os.path.split(relPath)
+        dir_fe = FE(tail, head, self.ensureDir(head), "-", 0)
+        self.MM.files.append(dir_fe)
+        self.entities[relPath] = dir_fe
+        return dir_fe
+
+    def remove(self, relPath, removed, moved):
+        """Forget a path and everything below it
+
+        The stats and hashes of files are put in moved in case they turn up
+        somewhere else
+        """
+        paths = [relPath]
+        if self.entities[relPath].hashd == '-':
+            prefix = relPath + os.path.sep
+            paths += [p for p in self.entities if p.startswith(prefix)]
+        for rel_path in paths:
+            fe = self.entities.pop(rel_path)
+            removed.add(id(fe))
+            key = self.MM.stats.pop(rel_path, None)
+            blocks = self.MM.blocks.pop(rel_path, None)
+            if key is not None and fe.hashd not in ['-', '?']:
+                moved[key] = (fe.hashd, blocks)
+        # don't hash anything that has gone
+        self.MM.toHash = [f for f in self.MM.toHash if id(f) not in removed]
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################